@@ -0,0 +1,166 @@
+import argparse
+import yaml
+import os
+import logging
+import json
+import time
+import datetime
+import threading
+import multiprocessing
+import asyncio
+import contextlib
+import platform
+import tempfile
+import resource
+import sys
+from time import perf_counter
+from urllib.parse import urlparse
+
+import smoke
+import server
+
+def serve(config, host, port):
+    """ Run the stand-in server with no latency, errors or stage durations, in its own process. """
+    server.args = argparse.Namespace(**config)
+    server.args.server = {"latency": {}, "errors": {}, "stages": {stage: {"dist": "fixed", "value": 0} for stage, field, service in server.Server.STAGES}}
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(server.Server().serve(host, port))
+
+def rss():
+    """ Return the current resident set size in MB, or None where /proc is not available. """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576
+    except (OSError, ValueError):
+        return None
+
+def measure(s, scenario, run):
+    """ Call run() while sampling threads, queued and in-flight calls, and return its client CPU, wall time, peaks and RSS. """
+    peaks = {"threads": 0, "queued": 0, "in_flight": 0}
+    done = threading.Event()
+    def sample():
+        while not done.is_set():
+            peaks["threads"] = max(peaks["threads"], threading.active_count())
+            peaks["queued"] = max(peaks["queued"], s.engine.queued())
+            peaks["in_flight"] = max(peaks["in_flight"], s.engine.running)
+            done.wait(0.01)
+    sampler = threading.Thread(target=sample, name='bench-sampler', daemon=True)
+    sampler.start()
+    cpu = time.process_time()
+    wall = perf_counter()
+    result = run()
+    wall = perf_counter() - wall
+    cpu = time.process_time() - cpu
+    done.set()
+    sampler.join()
+    result.update(scenario)
+    result.update({
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_per_item_ms": round(cpu * 1000 / max(result["items"], 1), 4),
+        "peak_threads": peaks["threads"],
+        "peak_queued": peaks["queued"],
+        "peak_in_flight": peaks["in_flight"],
+        "rss_mb": rss(),
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+    logging.getLogger('gxp-bench').info(f'{scenario}: {result}')
+    return result
+
+def nft(s, kind, flow, tps, seconds):
+    """ Run an industry or extraction plan at a flat TPS and return achieved TPS, send-time jitter and errors. """
+    # Achieved TPS counts completed responses until the last one came back, and jitter is measured when each call is actually sent
+    result = s.run_nft({"kind": kind, "flow": flow, "track": False, "phases": [{"shape": "flat", "from": tps, "to": tps, "seconds": seconds, "label": f'{tps} TPS'}]})
+    return {
+        "items": result["sent"],
+        "target_tps": tps,
+        "achieved_tps": round(s.stats.latency.total / result["drained"], 1),
+        "errors": s.stats.errors(),
+        "jitter_p50_ms": round(s.lag.percentile(50) * 1000, 3),
+        "jitter_p99_ms": round(s.lag.percentile(99) * 1000, 3),
+        "jitter_max_ms": round(s.lag.max / 1000, 3),
+        "late_over_10ms": s.lag.count_above(0.01),
+    }
+
+def uploads(s, flow, count):
+    """ Upload count transactions of flow, each under its own results key, for the mock and report scenarios. """
+    s.results = {f'{flow[:-5]}_{i:06d}.json': smoke.Transaction(flow, i) for i in range(count)}
+    s.fan_out(s.send_upload, [(transaction, s.template(flow).render(s.payloads[flow], transaction.seq)) for transaction in s.results.values()])
+    return s
+
+def mocks(s):
+    """ Mock sanctions for every transaction in s.results. """
+    s.mock_sanctions()
+    return {"items": len(s.results), "batched": smoke.setting('batch', 'mock', False)}
+
+def reports(s):
+    """ Resolve and print the report of every transaction in s.results, without the printing going to the console. """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        s.report_2(verbose=False)
+    return {"items": len(s.results), "resolved": sum(1 for result in s.results.values() if result.status)}
+
+if __name__ == '__main__':
+    # argparse
+    parser = argparse.ArgumentParser(description='Benchmark the overhead of the GXP Smoke client against a local zero-latency stand-in server.')
+    parser.add_argument('-e', '--env', type=str, default='local', help='environment whose config.yaml gives the endpoint templates, payloads and client settings')
+    parser.add_argument('-t', '--tps', type=int, nargs='+', default=[100, 500, 1000], help='target TPS for the industry and extraction scenarios')
+    parser.add_argument('-s', '--secs', type=int, default=10, help='seconds per industry and extraction scenario')
+    parser.add_argument('-n', '--transactions', type=int, default=1000, help='transactions for the mock and report scenarios')
+    parser.add_argument('-p', '--port', type=int, default=18181, help='port for the stand-in server')
+    parser.add_argument('-l', '--log-level', type=str, default='WARNING', help='client log level, INFO includes the cost of logging every request')
+    parser.add_argument('-o', '--output', type=str, help='result file, defaults to smoke/<env>/gxp-bench-<timestamp>.json')
+    args = parser.parse_args()
+
+    # Load config based on -e or --env flag
+    path = f'config/{args.env}/config.yaml'
+    if not os.path.exists(path):
+        print(f'{path} not found!')
+        sys.exit()
+    with open(path) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    # Point the client at the stand-in server and keep its journal and id cache out of the env's
+    host = '127.0.0.1'
+    config["endpoint"] = dict(config["endpoint"], base=f'http://{host}:{args.port}', extraction=urlparse(config["endpoint"]["extraction"])._replace(netloc=f'{host}:{args.port}').geturl())
+    scratch = tempfile.mkdtemp()
+    config["journal"] = dict(config.get("journal") or {}, path=os.path.join(scratch, 'journal.db'))
+    # A fresh id cache, so the report scenario searches every id instead of reusing earlier runs' mappings
+    config["ids"] = dict(config.get("ids") or {}, path=os.path.join(scratch, 'ids.db'))
+    config["tracker"] = dict(config.get("tracker") or {}, enabled=False)
+    config["progress"] = dict(config.get("progress") or {}, enabled=False)
+    smoke.args = argparse.Namespace(**config)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(threadName)-12s %(name)-12s %(levelname)-8s %(message)s')
+    logging.getLogger('gxp-bench').setLevel(logging.INFO)
+
+    # server
+    process = multiprocessing.get_context('spawn').Process(target=serve, args=(config, host, args.port), daemon=True)
+    process.start()
+    time.sleep(2)
+
+    # client
+    s = smoke.Smoke().load()
+    flow = sorted(s.payloads.keys())[0]
+    results = list()
+    try:
+        for tps in args.tps:
+            results.append(measure(s, {"scenario": "industry", "flow": flow}, lambda: nft(s, "industry", flow, tps, args.secs)))
+        for tps in args.tps:
+            results.append(measure(s, {"scenario": "extraction"}, lambda: nft(s, "extraction", "extraction_bulk", tps, args.secs)))
+        uploads(s, flow, args.transactions)
+        results.append(measure(s, {"scenario": "mock"}, lambda: mocks(s)))
+        results.append(measure(s, {"scenario": "report"}, lambda: reports(s)))
+    finally:
+        process.terminate()
+
+    # Print a summary and save every measure
+    print(f'\n[GXP Smoke client benchmark on {time.ctime().upper()} - {args.env}]\n'.upper())
+    for result in results:
+        rate = f'{result["achieved_tps"]}/{result["target_tps"]} TPS, jitter p99 = {result["jitter_p99_ms"]} ms, ' if "target_tps" in result else ''
+        print(f'{result["scenario"]}: {result["items"]} items, {rate}cpu = {result["cpu_per_item_ms"]} ms/item, peak threads = {result["peak_threads"]}, peak queued = {result["peak_queued"]}, peak in flight = {result["peak_in_flight"]}, peak rss = {result["peak_rss_mb"]} MB')
+    print(f'\n[END]\n')
+    output = args.output or f'smoke/{args.env}/gxp-bench-{datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}.json'
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({"env": args.env, "time": time.ctime(), "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(), "engine": config.get("engine", {}), "session": config.get("session", {}), "batch": config.get("batch", {}), "log_level": args.log_level, "results": results}, f, indent=4)
+    print(f'Benchmark results saved to [{output}]')
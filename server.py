@@ -0,0 +1,241 @@
+import argparse
+import yaml
+import os
+import logging
+import json
+import time
+import math
+import random
+import itertools
+import asyncio
+import re
+import sys
+from urllib.parse import urlparse, parse_qs
+
+def setting(section, key, default):
+    """ Return args.<section>[key] from config.yaml, or default if it is not configured. """
+    return (getattr(args, section, None) or {}).get(key, default)
+
+class Distribution:
+    """ Latency distribution from config, e.g. {dist: lognormal, median: 0.05, sigma: 0.5}, in seconds. """
+
+    def __init__(self, config):
+        self.config = config or {"dist": "fixed", "value": 0}
+
+    def sample(self):
+        """ Return one duration in seconds. """
+        config = self.config
+        dist = config.get("dist", "fixed")
+        if dist == 'uniform':
+            value = random.uniform(config["min"], config["max"])
+        elif dist == 'normal':
+            value = random.gauss(config["mean"], config["stddev"])
+        elif dist == 'lognormal':
+            value = random.lognormvariate(math.log(config["median"]), config["sigma"])
+        elif dist == 'exponential':
+            value = random.expovariate(1 / config["mean"])
+        else:
+            value = config.get("value", 0)
+        return max(0.0, min(value, config.get("max_value", value)))
+
+class Transaction:
+    """ Transaction accepted by the stand-in server, with how long each stage takes and which stages wait for a mock. """
+
+    __slots__ = ('firm_root_id', 'p3_id', 'end_to_end_id', 'created', 'durations', 'waits', 'mocked')
+
+    def __init__(self, firm_root_id, p3_id, end_to_end_id, created, durations, waits):
+        self.firm_root_id = firm_root_id
+        self.p3_id = p3_id
+        self.end_to_end_id = end_to_end_id
+        self.created = created
+        self.durations = durations
+        self.waits = waits
+        self.mocked = {}
+
+class Server:
+    """ Stand-in for the GXP upload, mock, search and extraction endpoints the smoke client calls. """
+
+    # Stage status fields in processing order, and the mock service which completes each stage when it waits for a mock
+    STAGES = [('qualification', 'qualificationStatus', None), ('sanctions', 'sanctionsStatus', 'sanctions'), ('funds', 'fundsControlStatus', 'fundcontrol'), ('settlement', 'settStatus', 'clearing'), ('posting', 'postStatus', 'posting')]
+    FIELDS = {stage: field for stage, field, service in STAGES}
+
+    def __init__(self):
+        self.logger = logging.getLogger('gxp-server')
+        self.transactions = {}
+        self.by_end_to_end_id = {}
+        self.sequence = itertools.count(1)
+        self.latency = {endpoint: Distribution(setting('server', 'latency', {}).get(endpoint)) for endpoint in ['upload', 'mock', 'search', 'extraction']}
+        self.errors = setting('server', 'errors', {})
+        self.stages = {stage: Distribution(setting('server', 'stages', {}).get(stage, {"dist": "fixed", "value": 0.5})) for stage, field, service in self.STAGES}
+        self.routes = self.new_routes()
+        self.params = self.search_params()
+
+    def new_routes(self):
+        """ Return (endpoint, path regex) for each endpoint, built from the same endpoint templates the client uses. """
+        urls = {
+            'upload': "/".join([args.endpoint["base"], args.endpoint["upload"]]),
+            'mock': "/".join([args.endpoint["base"], args.endpoint["mock"]]),
+            'search': "/".join([args.endpoint["base"], args.endpoint["search"]]),
+            'extraction': args.endpoint["extraction"],
+        }
+        routes = list()
+        for endpoint, url in urls.items():
+            path = re.escape(urlparse(url.replace('{env}', args.endpoint["env"])).path)
+            for name in ['service', 'region']:
+                path = path.replace(re.escape('{' + name + '}'), f'(?P<{name}>[^/]+)')
+            routes.append((endpoint, re.compile(f'^{path}$')))
+        return routes
+
+    def search_params(self):
+        """ Return the query parameter names which carry the ids and the id type in the search template. """
+        query = parse_qs(urlparse(args.endpoint["search"]).query)
+        ids = [name for name, values in query.items() if values[0] == '{ids}']
+        id_type = [name for name, values in query.items() if values[0] == 'FIRM_ROOT_ID']
+        return (ids[0] if ids else 'ids'), (id_type[0] if id_type else 'idType')
+
+    async def handle(self, reader, writer):
+        """ Serve keep-alive HTTP/1.1 requests on one connection until the client closes it. """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = header.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self.respond(method, target, body)
+                encoded = json.dumps(response).encode()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                # One write per response, so headers and body leave in the same segment
+                writer.write(f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\nContent-Type: application/json\r\nContent-Length: {len(encoded)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + encoded)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target, body):
+        """ Route a request to its endpoint after the configured latency, or fail it at the configured error rate. """
+        url = urlparse(target)
+        for endpoint, route in self.routes:
+            match = route.match(url.path)
+            if match:
+                break
+        else:
+            return 404, {"error": f'No endpoint for {url.path}'}
+        await asyncio.sleep(self.latency[endpoint].sample())
+        error = self.errors.get(endpoint, {})
+        if random.random() < error.get("rate", 0):
+            return error.get("status", 500), {"error": 'Injected error'}
+        if endpoint == 'upload':
+            return 200, self.upload(json.loads(body))
+        elif endpoint == 'mock':
+            return 200, self.mock(match.group('service'), json.loads(body))
+        elif endpoint == 'search':
+            return 200, self.find(match.group('region'), parse_qs(url.query))
+        return 200, [transaction.firm_root_id for transaction in itertools.islice(reversed(self.transactions.values()), setting('server', 'extraction_size', 5))]
+
+    def upload(self, payload):
+        """ Accept a payload and draw how long each of its stages takes. """
+        sequence = next(self.sequence)
+        durations = tuple(self.stages[stage].sample() for stage, field, service in self.STAGES)
+
+        # Stages wait for a mock when the payload asks for mocking and does not carry the response itself
+        waits = set()
+        for stage, field, service in self.STAGES:
+            key = args.payload["mock"].get(service, {}).get("key") if service else None
+            if payload.get("businessLive") == 'N' and key and not payload.get(key):
+                waits.add(stage)
+        transaction = Transaction(f'{sequence:016d}', f'P3{sequence:014d}', f'E2E{sequence:013d}', time.time(), durations, waits)
+        self.transactions[transaction.firm_root_id] = transaction
+        self.by_end_to_end_id[transaction.end_to_end_id] = transaction
+        firm_root_id = None if random.random() < setting('server', 'null_firm_root_id', 0) else transaction.firm_root_id
+        return {"firmRootId": firm_root_id, "p3Id": None, "endToEndId": transaction.end_to_end_id}
+
+    def mock(self, service, items):
+        """ Record the mocked response of each transaction, which completes its stage from now on. """
+        stages = [stage for stage, field, mocked in self.STAGES if mocked == service]
+        for item in items:
+            transaction = self.transactions.get(item.get("firmRootId"))
+            if transaction and stages:
+                transaction.mocked[stages[0]] = (time.time(), item.get(args.payload["mock"][service]["key"], ''))
+        return items
+
+    def completed(self, transaction):
+        """ Return when each stage completes, which is never while it or an earlier stage waits for a mock. """
+        done = {}
+        at = transaction.created
+        for (stage, field, service), duration in zip(self.STAGES, transaction.durations):
+            if stage in transaction.mocked:
+                at = max(at, transaction.mocked[stage][0])
+            elif stage in transaction.waits:
+                at = math.inf
+            else:
+                at += duration
+            done[stage] = at
+        return done
+
+    def find(self, region, query):
+        """ Return TransactionDetail or TransactionStatus records for the searched ids. """
+        ids_param, type_param = self.params
+        ids = query.get(ids_param, [''])[0].split(setting('batch', 'search_separator', ','))
+        by = self.by_end_to_end_id if query.get(type_param, ['FIRM_ROOT_ID'])[0] == 'END_TO_END_ID' else self.transactions
+        records = list()
+        now = time.time()
+        for transaction in filter(None, (by.get(i) for i in ids)):
+            if region == 'TransactionDetail':
+                records.append({"firmRootId": transaction.firm_root_id, "p3Id": transaction.p3_id, "endToEndId": transaction.end_to_end_id})
+                continue
+            record = {"firmRootId": transaction.firm_root_id}
+            for stage, done in self.completed(transaction).items():
+                rejected = 'REJECT' in transaction.mocked.get(stage, (0, ''))[1].upper()
+                record[self.FIELDS[stage]] = 'FAILED' if rejected and done <= now else ('PASSED' if done <= now else 'PENDING')
+            statuses = list(record.values())[1:]
+            record["tranStatus"] = 'RJCT' if 'FAILED' in statuses else ('CMP' if 'PENDING' not in statuses else 'PDG')
+            records.append(record)
+        return records
+
+    async def serve(self, host, port):
+        """ Listen on host:port until interrupted. """
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        self.logger.info(f'Stand-in GXP server for [{args.endpoint["env"]}] listening on {host}:{port} ...')
+        async with server:
+            await server.serve_forever()
+
+if __name__ == '__main__':
+    # argparse
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the GXP endpoints used by GXP Smoke.')
+    parser.add_argument('-e', '--env', type=str, default='local', help='environment whose config.yaml describes the endpoints and the server section')
+    parser.add_argument('-b', '--bind', type=str, help='[host:]port to listen on, defaults to the host and port of endpoint.base')
+    args = parser.parse_args()
+
+    # Load config based on -e or --env flag
+    path = f'config/{args.env}/config.yaml'
+    if not os.path.exists(path):
+        print(f'{path} not found!')
+        sys.exit()
+    with open(path) as f:
+        data = yaml.load(f, Loader=yaml.FullLoader)
+        for k, v in data.items():
+            args.__setattr__(k, v)
+
+    # logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+
+    # server
+    base = urlparse(args.endpoint["base"])
+    host, port = base.hostname, base.port or 80
+    if args.bind:
+        host, port = args.bind.rsplit(':', 1) if ':' in args.bind else (host, args.bind)
+    try:
+        asyncio.run(Server().serve(host, int(port)))
+    except KeyboardInterrupt:
+        pass
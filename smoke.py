@@ -3,19 +3,1242 @@ import yaml
 import os
 import logging
 import requests
+from urllib3.exceptions import NewConnectionError
 import json
+import mmap
+import struct
+import array
+import sqlite3
+import queue
 import time
 import datetime
+import math
+import random
+import bisect
 import threading
+import multiprocessing
+import asyncio
+from contextlib import closing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import pdb
 from time import perf_counter
 import sys
+import socket
+import socketserver
+import http.server
+
+def setting(section, key, default):
+    """ Return args.<section>[key] from config.yaml, or default if it is not configured. """
+    return (getattr(args, section, None) or {}).get(key, default)
+
+class Engine:
+    """ Base class for engines which run blocking request calls concurrently. """
+
+    def __init__(self):
+        self.logger = logging.getLogger('gxp-smoke')
+        self.pending = 0
+        self.running = 0
+        self.idle = threading.Condition()
+
+    def started(self):
+        """ Count a submitted call as pending until it finishes. """
+        with self.idle:
+            self.pending += 1
+
+    def execute(self, target, *call):
+        """ Run target(*call), counted as in flight while it runs. """
+        with self.idle:
+            self.running += 1
+        try:
+            return target(*call)
+        finally:
+            with self.idle:
+                self.running -= 1
+
+    def queued(self):
+        """ Return the submitted calls still waiting for a free slot. """
+        return max(0, self.pending - self.running)
+
+    def finished(self, future):
+        """ Log a failed call and release it from the in-flight count. """
+        # Calls refused by an open circuit breaker are counted as OPEN, the breaker logs when it opens and closes
+        if not future.cancelled() and future.exception() and not isinstance(future.exception(), CircuitOpen):
+            self.logger.error(f'Request failed: {future.exception()!r}')
+        with self.idle:
+            self.pending -= 1
+            if not self.pending:
+                self.idle.notify_all()
+
+    def drain(self):
+        """ Block until every submitted call has finished. """
+        with self.idle:
+            self.idle.wait_for(lambda: not self.pending)
+        return self
+
+class ThreadEngine(Engine):
+    """ Fallback engine which starts one thread per call. """
+
+    def submit(self, target, *call):
+        """ Run target(*call) on its own thread and return a Future for its result. """
+        future = Future()
+        self.started()
+        future.add_done_callback(self.finished)
+        threading.Thread(target=self.run, args=(future, target, call)).start()
+        return future
+
+    def run(self, future, target, call):
+        """ Thread body which resolves future with the result of target(*call). """
+        try:
+            future.set_result(self.execute(target, *call))
+        except BaseException as e:
+            future.set_exception(e)
+
+class AsyncEngine(Engine):
+    """ Engine which schedules calls on an asyncio event loop with at most 'concurrency' calls in flight. """
+
+    def __init__(self, concurrency):
+        super().__init__()
+        # requests is blocking, so calls run on a fixed executor pool and the loop only queues them
+        self.concurrency = concurrency
+        self.semaphore = None
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='engine'))
+        threading.Thread(target=self.loop.run_forever, name='engine-loop', daemon=True).start()
+
+    async def call(self, target, call):
+        """ Coroutine which runs target(*call) on the executor once a concurrency slot is free. """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            return await self.loop.run_in_executor(None, self.execute, target, *call)
+
+    def submit(self, target, *call):
+        """ Schedule target(*call) on the event loop and return a Future for its result. """
+        self.started()
+        future = asyncio.run_coroutine_threadsafe(self.call(target, call), self.loop)
+        future.add_done_callback(self.finished)
+        return future
+
+class CircuitOpen(requests.RequestException):
+    """ Raised instead of calling an endpoint while its circuit breaker is open. """
+
+class Breaker:
+    """ Retry budget and circuit breaker of one endpoint, with counts of retries and trips for run metrics. """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, endpoint):
+        self.logger = logging.getLogger('gxp-smoke')
+        self.endpoint = endpoint
+        overrides = setting('retry', 'endpoints', {}).get(endpoint, {})
+        # Uploads are payments, so they are not retried unless retry.endpoints.upload asks for it
+        self.attempts = overrides.get("attempts", 0 if endpoint == 'upload' else setting('retry', 'attempts', 2))
+        self.retry_statuses = overrides.get("statuses", setting('retry', 'statuses', [429, 503]))
+        self.backoff = setting('retry', 'backoff', 0.1)
+        self.max_backoff = setting('retry', 'max_backoff', 5)
+        self.budget = setting('retry', 'budget', 0.2)
+        self.burst = setting('retry', 'budget_burst', 10)
+        self.enabled = setting('breaker', 'enabled', True)
+        self.failures = setting('breaker', 'failures', 50)
+        self.reset_after = setting('breaker', 'reset', 10)
+        self.failure_statuses = setting('breaker', 'statuses', [429, 500, 502, 503, 504])
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.opened = 0.0
+        self.tokens = self.burst
+        self.reset()
+
+    def reset(self):
+        """ Zero the counts of the current run, keeping the breaker state. """
+        with self.lock:
+            self.counts = {"retries": 0, "exhausted": 0, "trips": 0, "rejected": 0}
+        return self
+
+    def allow(self):
+        """ Return whether a call may go out now, letting one trial call through once the breaker has been open for breaker.reset seconds. """
+        with self.lock:
+            # Each call earns a fraction of a retry, so retries stay within retry.budget of the load
+            self.tokens = min(self.burst, self.tokens + self.budget)
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened >= self.reset_after:
+                self.state = self.HALF_OPEN
+                return True
+            self.counts["rejected"] += 1
+            return False
+
+    def success(self):
+        """ Close the breaker after a call which did not fail. """
+        with self.lock:
+            if self.state != self.CLOSED:
+                self.logger.info(f'Circuit breaker for [{self.endpoint}] closed')
+            self.state = self.CLOSED
+            self.consecutive = 0
+        return self
+
+    def failure(self):
+        """ Count a failed call, opening the breaker after breaker.failures in a row or a failed trial call. """
+        with self.lock:
+            self.consecutive += 1
+            if self.enabled and (self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutive >= self.failures)):
+                self.state = self.OPEN
+                self.opened = time.time()
+                self.counts["trips"] += 1
+                self.logger.warning(f'Circuit breaker for [{self.endpoint}] opened after {self.consecutive} failures in a row, trial call in {self.reset_after} seconds')
+        return self
+
+    def retry(self, attempt):
+        """ Return whether a failed call may be retried, spending one retry from the budget. """
+        with self.lock:
+            if attempt >= self.attempts or self.state == self.OPEN:
+                return False
+            if self.tokens < 1:
+                self.counts["exhausted"] += 1
+                return False
+            self.tokens -= 1
+            self.counts["retries"] += 1
+            return True
+
+    def delay(self, attempt, response=None):
+        """ Return seconds to wait before retry attempt, with full jitter, or the response's Retry-After. """
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            return min(int(retry_after), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+class ResilientSession(requests.Session):
+    """ Session which retries connection errors and retry.statuses with backoff, behind its endpoint's circuit breaker. """
+
+    def __init__(self, breaker, timeout):
+        super().__init__()
+        self.breaker = breaker
+        self.timeout = timeout
+
+    @staticmethod
+    def retryable(method, error):
+        """ Return whether a failed call may be sent again: any connection error or timeout for GET, only failures to connect for POST. """
+        if method.upper() == 'GET':
+            return isinstance(error, (requests.ConnectionError, requests.Timeout))
+        # A POST dropped after the body went out may already have been accepted
+        return isinstance(error, requests.ConnectTimeout) or (isinstance(error, requests.ConnectionError) and isinstance(getattr(error.args[0] if error.args else None, 'reason', None), NewConnectionError))
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpen(f'Circuit breaker for [{self.breaker.endpoint}] is open')
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.RequestException as e:
+                self.breaker.failure()
+                if not self.retryable(method, e) or not self.breaker.retry(attempt):
+                    raise
+                response = None
+            else:
+                if response.status_code not in self.breaker.failure_statuses:
+                    self.breaker.success()
+                    return response
+                self.breaker.failure()
+                if response.status_code not in self.breaker.retry_statuses or not self.breaker.retry(attempt):
+                    return response
+            time.sleep(self.breaker.delay(attempt, response))
+            attempt += 1
+
+class Histogram:
+    """ Mergeable HDR-style histogram of durations in log-linear microsecond buckets (< 1.6% error). """
+
+    SUB_BUCKETS = 128
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def index(cls, value):
+        """ Return the bucket index of a value in microseconds. """
+        if value < cls.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - cls.SUB_BUCKETS.bit_length() + 1
+        return (shift + 1) * (cls.SUB_BUCKETS // 2) + (value >> shift)
+
+    @classmethod
+    def highest(cls, index):
+        """ Return the highest value in microseconds which falls into a bucket. """
+        half = cls.SUB_BUCKETS // 2
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift = index // half - 2
+        return ((index % half + half + 1) << shift) - 1
+
+    def record(self, seconds):
+        """ Record a duration in seconds. """
+        value = max(0, int(seconds * 1000000))
+        index = self.index(value)
+        with self.lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.total += 1
+            self.sum += value
+            self.max = max(self.max, value)
+        return self
+
+    def merge(self, other):
+        """ Add the counts of another histogram to this one. """
+        with self.lock:
+            for index, count in other.counts.items():
+                self.counts[index] = self.counts.get(index, 0) + count
+            self.total += other.total
+            self.sum += other.sum
+            self.max = max(self.max, other.max)
+        return self
+
+    def to_dict(self):
+        """ Return counts as a plain dict which can be pickled or sent as JSON. """
+        with self.lock:
+            return {"counts": dict(self.counts), "total": self.total, "sum": self.sum, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Return a histogram from the output of to_dict. """
+        histogram = cls()
+        histogram.counts = {int(index): count for index, count in data["counts"].items()}
+        histogram.total = data["total"]
+        histogram.sum = data["sum"]
+        histogram.max = data["max"]
+        return histogram
+
+    def percentile(self, percent):
+        """ Return the duration in seconds at or below which percent of recorded values fall. """
+        if not self.total:
+            return 0.0
+        rank = max(1, int(round(self.total * percent / 100)))
+        seen = 0
+        for index in sorted(self.counts.keys()):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.highest(index), self.max) / 1000000
+        return self.max / 1000000
+
+    def count_above(self, seconds):
+        """ Return the number of recorded values above a duration in seconds. """
+        limit = self.index(int(seconds * 1000000))
+        return sum(count for index, count in self.counts.items() if index > limit)
+
+    def mean(self):
+        """ Return the mean duration in seconds. """
+        return self.sum / self.total / 1000000 if self.total else 0.0
+
+    def summary(self):
+        """ Return count, mean, p50/p90/p99/p99.9 and max in ms. """
+        percentiles = ', '.join(f'p{p:g} = {self.percentile(p) * 1000:.3f} ms' for p in [50, 90, 99, 99.9])
+        return f'count = {self.total}, mean = {self.mean() * 1000:.3f} ms, {percentiles}, max = {self.max / 1000:.3f} ms'
+
+class RunStats:
+    """ Request latency histogram and counts by HTTP status for a run. """
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+    def record(self, seconds, status):
+        """ Record one request by latency in seconds and HTTP status, or 'ERR' if no response came back, with no latency for calls never sent ('OPEN'). """
+        if seconds is not None:
+            self.latency.record(seconds)
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        return self
+
+    def merge(self, other):
+        """ Add the latencies and status counts of another run to this one. """
+        self.latency.merge(other.latency)
+        with self.lock:
+            for status, count in other.statuses.items():
+                self.statuses[status] = self.statuses.get(status, 0) + count
+        return self
+
+    def to_dict(self):
+        """ Return latencies and status counts as a plain dict which can be pickled or sent as JSON. """
+        with self.lock:
+            return {"latency": self.latency.to_dict(), "statuses": dict(self.statuses)}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Return run stats from the output of to_dict. """
+        stats = cls()
+        stats.latency = Histogram.from_dict(data["latency"])
+        stats.statuses = {int(status) if str(status).isdigit() else status: count for status, count in data["statuses"].items()}
+        return stats
+
+    def total(self):
+        """ Return the number of requests, including those never sent. """
+        with self.lock:
+            return sum(self.statuses.values())
+
+    def errors(self):
+        """ Return the number of requests which did not return HTTP 200. """
+        return sum(count for status, count in self.statuses.items() if status != 200)
+
+    def summary(self):
+        """ Return summary lines of latency percentiles and errors by HTTP status. """
+        statuses = ', '.join(f'{status} = {count}' for status, count in sorted(self.statuses.items(), key=lambda item: str(item[0])))
+        return [f'Latency: {self.latency.summary()}', f'Errors: {self.errors()}/{self.total()} (by HTTP status: {statuses})']
+
+class Metrics:
+    """ Live counters and gauges of the current NFT run, served in Prometheus text format and summarised on one console line. """
+
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+    WINDOWS = [1, 10, 60]
+
+    def __init__(self, smoke):
+        self.logger = logging.getLogger('gxp-smoke')
+        self.smoke = smoke
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.progress = None
+        self.levels = []
+        self.start()
+
+    def start(self, kind='', planned=0, scheduler=None, label='', start_at=None):
+        """ Reset counters for a run of planned transactions sent by scheduler from start_at, and start the console summary if enabled. """
+        with self.lock:
+            self.kind = kind
+            self.planned = planned
+            self.scheduler = scheduler
+            self.latency = Histogram()
+            self.statuses = {}
+            self.seconds = {}
+            self.started = int(start_at or time.time())
+        if scheduler and setting('progress', 'enabled', True):
+            self.done.clear()
+            self.progress = threading.Thread(target=self.print_progress, args=(label,), name='progress', daemon=True)
+            self.progress.start()
+        return self
+
+    def stop(self):
+        """ Stop the console summary after printing it one last time. """
+        if self.progress:
+            self.done.set()
+            self.progress.join()
+            self.progress = None
+        return self
+
+    def record(self, seconds, status):
+        """ Record one response by latency in seconds and HTTP status, or 'ERR' if no response came back, with no latency for calls never sent ('OPEN'). """
+        now = int(time.time())
+        if seconds is not None:
+            self.latency.record(seconds)
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if now not in self.seconds:
+                # Keep only the seconds of the longest window
+                for second in [second for second in self.seconds.keys() if second < now - self.WINDOWS[-1]]:
+                    del self.seconds[second]
+                self.seconds[now] = 0
+            self.seconds[now] += 1
+        return self
+
+    def tps(self, window):
+        """ Return responses per second over the last window seconds, or since the run started if that is shorter, not counting the current second. """
+        now = int(time.time())
+        with self.lock:
+            return sum(count for second, count in self.seconds.items() if now - window <= second < now) / max(1, min(window, now - self.started))
+
+    def sent(self):
+        """ Return the transactions sent so far in the current run, leaving out those still queued in the engine. """
+        return self.scheduler.lag.total if self.scheduler else 0
+
+    def summary(self):
+        """ Return one line of progress, throughput, latency and errors. """
+        with self.lock:
+            statuses = dict(self.statuses)
+        ok = statuses.pop(200, 0)
+        errors = ', '.join(f'{status} = {count}' for status, count in sorted(statuses.items(), key=lambda item: str(item[0])))
+        tps = '/'.join(f'{self.tps(window):.1f}' for window in self.WINDOWS)
+        tracking = f' | tracking {self.smoke.tracker.waiting()}' if self.smoke.tracker.running else ''
+        retries = sum(breaker.counts["retries"] for breaker in self.smoke.breakers.values())
+        opened = [endpoint for endpoint, breaker in self.smoke.breakers.items() if breaker.state != Breaker.CLOSED]
+        tracking += (f' | retries {retries}' if retries else '') + (f' | breaker open {opened}' if opened else '')
+        # A copy, as percentiles walk the buckets while responses keep coming in
+        latency = Histogram.from_dict(self.latency.to_dict())
+        return f'{self.kind} {self.sent()}/{self.planned} sent | {ok} ok, {sum(statuses.values())} err{f" ({errors})" if errors else ""} | queued {self.smoke.engine.queued()}, in flight {self.smoke.engine.running} | TPS {"/".join(f"{window}s" for window in self.WINDOWS)} = {tps} | p50 = {latency.percentile(50) * 1000:.1f} ms, p99 = {latency.percentile(99) * 1000:.1f} ms{tracking}'
+
+    def print_progress(self, label):
+        """ Rewrite the console summary every progress.interval seconds, or print it on a new line when the console is not a terminal. """
+        interval = setting('progress', 'interval', 1)
+        rewrite = sys.stderr.isatty() and not label
+        # Per-request lines still go to the log file while the summary has the console
+        if setting('progress', 'quiet', True):
+            self.levels = [(handler, handler.level) for handler in logging.getLogger().handlers if type(handler) is logging.StreamHandler]
+            for handler, level in self.levels:
+                handler.setLevel(logging.WARNING)
+        while not self.done.wait(interval):
+            sys.stderr.write(f'\r{label}{self.summary()}\x1b[K' if rewrite else f'{label}{self.summary()}\n')
+            sys.stderr.flush()
+        sys.stderr.write(f'\r{label}{self.summary()}\x1b[K\n' if rewrite else f'{label}{self.summary()}\n')
+        for handler, level in self.levels:
+            handler.setLevel(level)
+        self.levels = []
+
+    def exposition(self):
+        """ Return the metrics in Prometheus text exposition format. """
+        kind = f'kind="{self.kind}"'
+        lines = [
+            '# HELP gxp_smoke_planned Transactions planned in the current NFT run.', '# TYPE gxp_smoke_planned gauge', f'gxp_smoke_planned{{{kind}}} {self.planned}',
+            '# HELP gxp_smoke_sent_total Transactions dispatched in the current NFT run.', '# TYPE gxp_smoke_sent_total counter', f'gxp_smoke_sent_total{{{kind}}} {self.sent()}',
+            '# HELP gxp_smoke_responses_total Responses by HTTP status, or ERR when no response came back.', '# TYPE gxp_smoke_responses_total counter']
+        with self.lock:
+            statuses = dict(self.statuses)
+        lines += [f'gxp_smoke_responses_total{{{kind},status="{status}"}} {count}' for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))]
+        lines += ['# HELP gxp_smoke_queued Requests submitted but waiting for a free engine slot.', '# TYPE gxp_smoke_queued gauge', f'gxp_smoke_queued {self.smoke.engine.queued()}']
+        lines += ['# HELP gxp_smoke_in_flight Requests in flight.', '# TYPE gxp_smoke_in_flight gauge', f'gxp_smoke_in_flight {self.smoke.engine.running}']
+        lines += ['# HELP gxp_smoke_tps Responses per second over a sliding window.', '# TYPE gxp_smoke_tps gauge']
+        lines += [f'gxp_smoke_tps{{{kind},window="{window}s"}} {self.tps(window):.3f}' for window in self.WINDOWS]
+        breakers = self.smoke.breakers.items()
+        lines += ['# HELP gxp_smoke_retries_total Retried calls by endpoint.', '# TYPE gxp_smoke_retries_total counter']
+        lines += [f'gxp_smoke_retries_total{{endpoint="{endpoint}"}} {breaker.counts["retries"]}' for endpoint, breaker in breakers]
+        lines += ['# HELP gxp_smoke_retry_budget_exhausted_total Failed calls not retried because the retry budget was spent.', '# TYPE gxp_smoke_retry_budget_exhausted_total counter']
+        lines += [f'gxp_smoke_retry_budget_exhausted_total{{endpoint="{endpoint}"}} {breaker.counts["exhausted"]}' for endpoint, breaker in breakers]
+        lines += ['# HELP gxp_smoke_breaker_trips_total Times the circuit breaker opened by endpoint.', '# TYPE gxp_smoke_breaker_trips_total counter']
+        lines += [f'gxp_smoke_breaker_trips_total{{endpoint="{endpoint}"}} {breaker.counts["trips"]}' for endpoint, breaker in breakers]
+        lines += ['# HELP gxp_smoke_short_circuited_total Calls not sent because the circuit breaker was open.', '# TYPE gxp_smoke_short_circuited_total counter']
+        lines += [f'gxp_smoke_short_circuited_total{{endpoint="{endpoint}"}} {breaker.counts["rejected"]}' for endpoint, breaker in breakers]
+        lines += ['# HELP gxp_smoke_breaker_open Whether the circuit breaker is open (1), half-open (0.5) or closed (0).', '# TYPE gxp_smoke_breaker_open gauge']
+        lines += [f'gxp_smoke_breaker_open{{endpoint="{endpoint}"}} { {Breaker.OPEN: 1, Breaker.HALF_OPEN: 0.5}.get(breaker.state, 0)}' for endpoint, breaker in breakers]
+        lines += ['# HELP gxp_smoke_tracking Transactions tracked until a terminal tranStatus.', '# TYPE gxp_smoke_tracking gauge', f'gxp_smoke_tracking {self.smoke.tracker.waiting()}']
+        lines += ['# HELP gxp_smoke_latency_seconds Request latency.', '# TYPE gxp_smoke_latency_seconds histogram']
+        latency = Histogram.from_dict(self.latency.to_dict())
+        total = latency.total
+        lines += [f'gxp_smoke_latency_seconds_bucket{{{kind},le="{bucket:g}"}} {total - latency.count_above(bucket)}' for bucket in self.BUCKETS]
+        lines += [f'gxp_smoke_latency_seconds_bucket{{{kind},le="+Inf"}} {total}', f'gxp_smoke_latency_seconds_sum{{{kind}}} {latency.sum / 1000000:.6f}', f'gxp_smoke_latency_seconds_count{{{kind}}} {total}']
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host, port):
+        """ Serve the metrics on http://host:port/metrics from a background thread. """
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        server.metrics = self
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        self.logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return self
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """ Answer GET /metrics with the current run's metrics. """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class Scheduler:
+    """ Open-loop scheduler which dispatches each transaction at its planned send time. """
+
+    def __init__(self):
+        self.logger = logging.getLogger('gxp-smoke')
+        self.lag = Histogram()
+        self.start = 0
+        self.end = 0
+
+    @staticmethod
+    def constant(tps, seconds, index=0, count=1):
+        """ Yield planned send offsets in seconds for a flat TPS over a duration, every count-th one from index. """
+        for i in range(index, tps * seconds, count):
+            yield i / tps
+
+    @staticmethod
+    def intervals(per_interval, interval_seconds, intervals, index=0, count=1):
+        """ Yield planned send offsets in seconds for bursts of per_interval transactions on fixed ticks, every count-th one from index. """
+        for i in range(index, per_interval * intervals, count):
+            yield (i // per_interval) * interval_seconds
+
+    @staticmethod
+    def expand(profile):
+        """ Return the phases of a load profile from config, with each step of a step ladder as its own phase. """
+        phases = list()
+        for segment in profile:
+            seconds = segment.get("mins", 0) * 60 + segment.get("secs", 0)
+            if "step" in segment:
+                low, high, step = segment["step"]
+                for tps in range(low, high + (1 if step > 0 else -1), step):
+                    phases.append({"shape": "flat", "from": tps, "to": tps, "seconds": segment["hold"] * 60, "label": f'step {tps} TPS'})
+                continue
+            if seconds <= 0:
+                raise ValueError(f'Profile segment {segment} needs mins or secs')
+            if "ramp" in segment:
+                low, high = segment["ramp"]
+                phases.append({"shape": "ramp", "from": low, "to": high, "seconds": seconds, "label": f'ramp {low}-{high} TPS'})
+            elif "sine" in segment:
+                low, high = segment["sine"]
+                phases.append({"shape": "sine", "from": low, "to": high, "seconds": seconds, "period": segment["period"] * 60, "label": f'sine {low}-{high} TPS'})
+            else:
+                phases.append({"shape": "flat", "from": segment["tps"], "to": segment["tps"], "seconds": seconds, "label": f'{segment["tps"]} TPS'})
+        return phases
+
+    @staticmethod
+    def planned(phase, t):
+        """ Return how many transactions a phase plans to send in its first t seconds. """
+        low, high = phase["from"], phase["to"]
+        if phase["shape"] == "ramp":
+            return low * t + (high - low) * t * t / (2 * phase["seconds"])
+        elif phase["shape"] == "sine":
+            return (low + high) / 2 * t + (high - low) / 2 * phase["period"] / (2 * math.pi) * (1 - math.cos(2 * math.pi * t / phase["period"]))
+        return low * t
+
+    @staticmethod
+    def starts(phases):
+        """ Return the number of the first transaction of each phase, and the total number of transactions. """
+        starts = list()
+        total = 0.0
+        for phase in phases:
+            starts.append(round(total))
+            total += Scheduler.planned(phase, phase["seconds"])
+        return starts, round(total)
+
+    @staticmethod
+    def profile(phases, index=0, count=1):
+        """ Yield planned send offsets in seconds following the rate of each phase in turn, every count-th one from index. """
+        starts, total = Scheduler.starts(phases)
+        begin = 0
+        for phase, first, last in zip(phases, starts, starts[1:] + [total]):
+            planned = Scheduler.planned(phase, phase["seconds"])
+            for number in range(first + (index - first) % count, last, count):
+                # Time at which planned(phase, t) reaches this transaction, rescaled for rounding of the phase's total
+                sent = (number - first) * planned / (last - first)
+                if phase["shape"] == "sine":
+                    low, high = 0.0, phase["seconds"]
+                    while high - low > 1e-6:
+                        middle = (low + high) / 2
+                        low, high = (middle, high) if Scheduler.planned(phase, middle) < sent else (low, middle)
+                    offset = low
+                else:
+                    # Root of planned(phase, t) = sent, in the form which also holds for flat phases
+                    rate = phase["from"]
+                    change = (phase["to"] - phase["from"]) / phase["seconds"]
+                    offset = 2 * sent / (rate + math.sqrt(max(0.0, rate * rate + 2 * change * sent))) if sent else 0.0
+                yield begin + offset
+            begin += phase["seconds"]
+
+    def run(self, offsets, dispatch, start_at=None):
+        """ Call dispatch(seq, planned) at planned = start + offset for each planned offset, starting at wall-clock start_at or the next second. """
+        # Sleep until the start instead of spinning on time.time()
+        time.sleep(max(0, start_at - time.time()) if start_at else 1 - time.time() % 1)
+
+        # Offsets are absolute from start, so oversleeping never accumulates into drift
+        self.lag = Histogram()
+        self.start = perf_counter()
+        for seq, offset in enumerate(offsets, 1):
+            delay = self.start + offset - perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            dispatch(seq, self.start + offset)
+        self.end = perf_counter()
+        return self
+
+    def sent(self, planned):
+        """ Record the lag of a call sent now against its planned time, including any wait for a free engine slot. """
+        self.lag.record(perf_counter() - planned)
+        return self
+
+    def elapsed(self):
+        """ Return seconds from the first planned send to the end of the run. """
+        return (self.end if self.end else perf_counter()) - self.start
+
+class Tracker:
+    """ Background tracker which polls triggered transactions in batches until they reach a terminal tranStatus. """
+
+    STAGES = {'sanctions': 'sanctionsStatus', 'funds': 'fundsControlStatus', 'posting': 'postStatus', 'settlement': 'settStatus'}
+
+    # Mock services in the order a transaction triggered with mocking waits for them, with the status field which shows the wait
+    MOCKS = [('sanctions', 'sanctionsStatus'), ('fundcontrol', 'fundsControlStatus'), ('clearing', 'settStatus'), ('posting', 'postStatus')]
+
+    def __init__(self, smoke):
+        self.logger = logging.getLogger('gxp-smoke')
+        self.smoke = smoke
+        self.terminal = setting('tracker', 'terminal', ['CMP', 'RTN'])
+        self.pending_values = setting('tracker', 'pending_values', ['', 'PENDING', 'PDG'])
+        self.min_interval = setting('tracker', 'min_interval', 0.5)
+        self.max_interval = setting('tracker', 'max_interval', 10)
+        self.timeout = setting('tracker', 'timeout', 600)
+        self.backoff = setting('tracker', 'backoff', 0.1)
+        self.automock = setting('automock', 'enabled', False)
+        self.resend = setting('automock', 'resend', 30)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = False
+        self.reset()
+
+    def reset(self):
+        """ Forget tracked transactions and latencies. """
+        with self.lock:
+            self.tracked = {}
+            self.unresolved = []
+            self.due = {}
+            self.following = 0
+            self.latency = Histogram()
+            self.stages = {stage: Histogram() for stage in self.STAGES.keys()}
+            self.completed = 0
+            self.timed_out = 0
+        return self
+
+    def start(self):
+        """ Start polling in a background thread. """
+        if not self.running:
+            self.running = True
+            threading.Thread(target=self.run, name='tracker', daemon=True).start()
+            self.logger.info(f'Tracking end-to-end latency until tranStatus is one of {self.terminal} ...')
+        return self
+
+    def stop(self):
+        """ Stop polling. Transactions still tracked are kept until reset. """
+        self.running = False
+        self.wake.set()
+        return self
+
+    def track(self, transaction):
+        """ Follow a triggered transaction until it reaches a terminal tranStatus. """
+        if transaction.http_status == 200:
+            with self.lock:
+                if transaction.firm_root_id:
+                    self.tracked[transaction.firm_root_id] = (transaction, set(), {})
+                else:
+                    self.unresolved.append(transaction)
+        return self
+
+    def run(self):
+        """ Poll with adaptive backoff: back to min_interval on any status change, doubling up to max_interval otherwise. """
+        interval = self.min_interval
+        while self.running:
+            self.wake.wait(interval)
+            self.wake.clear()
+            if self.running:
+                interval = self.min_interval if self.poll() else min(interval * 2, self.max_interval)
+
+    def poll(self):
+        """ Fetch statuses of the tracked transactions which are due in bulk and return the number of status changes. """
+        start = time.time()
+        with self.lock:
+            # Transactions past tracker.timeout, whether or not their firmRootId was ever found
+            for firm_root_id, (transaction, done, actions) in list(self.tracked.items()):
+                if start - transaction.sent > self.timeout:
+                    self.timed_out += 1
+                    del self.tracked[firm_root_id]
+                    self.due.pop(firm_root_id, None)
+            unresolved = [transaction for transaction in self.unresolved if self.due.get(transaction.end_to_end_id, 0) <= start]
+            self.unresolved = [transaction for transaction in self.unresolved if self.due.get(transaction.end_to_end_id, 0) > start]
+
+        # firmRootId for transactions which only returned an endToEndId
+        if unresolved:
+            by_end_to_end_id = {transaction.end_to_end_id: transaction for transaction in unresolved}
+            for record in self.smoke.search_many('TransactionDetail', list(by_end_to_end_id.keys()), 'END_TO_END_ID'):
+                transaction = by_end_to_end_id.pop(record["endToEndId"], None)
+                if transaction:
+                    transaction.firm_root_id = record["firmRootId"]
+                    with self.lock:
+                        self.due.pop(transaction.end_to_end_id, None)
+                        self.tracked[transaction.firm_root_id] = (transaction, set(), {})
+            with self.lock:
+                for transaction in by_end_to_end_id.values():
+                    if start - transaction.sent > self.timeout:
+                        self.timed_out += 1
+                        self.due.pop(transaction.end_to_end_id, None)
+                    else:
+                        self.due[transaction.end_to_end_id] = self.next_due(transaction, start)
+                        self.unresolved.append(transaction)
+
+        # Status, stage and end-to-end latencies, timed at the poll which first sees them
+        with self.lock:
+            tracked = {firm_root_id: entry for firm_root_id, entry in self.tracked.items() if self.due.get(firm_root_id, 0) <= start}
+        if not tracked:
+            return 0
+        changes = 0
+        mocks = list()
+        returns = list()
+        records = self.smoke.search_many('TransactionStatus', list(tracked.keys()))
+        now = time.time()
+        with self.lock:
+            for transaction, done, actions in tracked.values():
+                self.due[transaction.firm_root_id] = self.next_due(transaction, now)
+            for record in records:
+                if record["firmRootId"] not in self.tracked:
+                    continue
+                transaction, done, actions = self.tracked[record["firmRootId"]]
+                sent = len(mocks) + len(returns)
+                changed = transaction.status != record
+                if changed:
+                    changes += 1
+                transaction.status = record
+                if self.automock and transaction.flow in self.smoke.mocked:
+                    mocks += self.next_mock(transaction, record, actions, now)
+                if self.smoke.pipeline and record["tranStatus"] in self.smoke.return_after and transaction.parent is None and transaction.flow in self.smoke.payloads_return and 'return' not in actions:
+                    actions['return'] = now
+                    returns.append(transaction)
+                    self.following += 1
+                # Back to min_interval after a change or a mock, as the next stage may follow soon
+                if changed or len(mocks) + len(returns) > sent:
+                    self.due[record["firmRootId"]] = now + self.min_interval
+                for stage, field in self.STAGES.items():
+                    if stage not in done and record.get(field, '') not in self.pending_values:
+                        done.add(stage)
+                        self.stages[stage].record(now - transaction.sent)
+                if record["tranStatus"] in self.terminal:
+                    self.latency.record(now - transaction.sent)
+                    self.completed += 1
+                    del self.tracked[record["firmRootId"]]
+                    self.due.pop(record["firmRootId"], None)
+
+        # Mocks and returns sent count as changes, so the next poll comes soon enough to see their effect
+        if mocks:
+            self.smoke.automock(mocks)
+        if returns:
+            self.smoke.fan_out(self.smoke.smoke_return_thread, [(transaction.seq, transaction.flow, transaction) for transaction in returns])
+            with self.lock:
+                self.following -= len(returns)
+        return changes + len(mocks) + len(returns)
+
+    def next_due(self, transaction, now):
+        """ Return when to poll a transaction next, backing off with its age up to max_interval, as most settle early or not at all. """
+        return now + min(self.max_interval, max(self.min_interval, (now - transaction.sent) * self.backoff))
+
+    def next_mock(self, transaction, record, actions, now):
+        """ Return [(service, transaction)] for the first mock the transaction waits for, unless it was sent less than automock.resend seconds ago. """
+        for service, field in self.MOCKS:
+            if record.get(field, '') in self.pending_values:
+                if now - actions.get(service, 0) < self.resend:
+                    return []
+                actions[service] = now
+                return [(service, transaction)]
+        return []
+
+    def unmock(self, service, transactions):
+        """ Forget that a service was mocked for transactions whose mock failed, so the next poll sends it again. """
+        with self.lock:
+            for transaction in transactions:
+                if transaction.firm_root_id in self.tracked:
+                    self.tracked[transaction.firm_root_id][2].pop(service, None)
+        return self
+
+    def waiting(self):
+        """ Return the number of transactions not yet at a terminal tranStatus. """
+        with self.lock:
+            return len(self.tracked) + len(self.unresolved) + self.following
+
+    def wait(self):
+        """ Block until every tracked transaction is terminal or has timed out, giving up a poll or two after tracker.timeout. """
+        self.logger.info(f'Waiting for {self.waiting()} tracked transactions to complete ...')
+        deadline = time.time() + self.timeout + 2 * self.max_interval
+        while self.running and self.waiting():
+            if time.time() > deadline:
+                self.logger.warning(f'Gave up waiting for {self.waiting()} tracked transactions after {self.timeout + 2 * self.max_interval} seconds')
+                break
+            time.sleep(self.min_interval)
+        return self
+
+    def to_dict(self):
+        """ Return latencies and counts as a plain dict which can be pickled or sent as JSON. """
+        with self.lock:
+            return {"latency": self.latency.to_dict(), "stages": {stage: histogram.to_dict() for stage, histogram in self.stages.items()}, "completed": self.completed, "timed_out": self.timed_out}
+
+    def merge(self, data):
+        """ Add latencies and counts from the to_dict output of another tracker. """
+        self.latency.merge(Histogram.from_dict(data["latency"]))
+        for stage, histogram in data["stages"].items():
+            self.stages[stage].merge(Histogram.from_dict(histogram))
+        with self.lock:
+            self.completed += data["completed"]
+            self.timed_out += data["timed_out"]
+        return self
+
+    def summary(self):
+        """ Return summary lines of end-to-end and per stage latency. """
+        lines = [f'End-to-end (tranStatus in {self.terminal}): {self.latency.summary()}']
+        for stage, histogram in self.stages.items():
+            lines.append(f'  {stage.capitalize()}: {histogram.summary()}')
+        lines.append(f'Completed = {self.completed}, timed out (> {self.timeout} s) = {self.timed_out}, still tracking = {self.waiting()}')
+        return lines
+
+class Template:
+    """ Payload pre-encoded to JSON bytes, with slots for the top-level fields which change between requests. """
+
+    SLOTS = ['additionalRemittanceInfo', 'valueDt', 'businessLive', 'sanctionsResponse', 'fasResponse', 'postingResponse', 'parentFirmRootId', 'parentP3Id', 'endToEndId']
+
+    def __init__(self, payload, suffix=None):
+        self.size = len(payload)
+        self.slots = [key for key in payload.keys() if key in self.SLOTS]
+        self.suffix = setting('template', 'suffix', '') if suffix is None else suffix
+
+        # Encode once with a marker in each slot, then cut the bytes around the markers
+        marked = dict(payload)
+        for key in self.slots:
+            marked[key] = '\x00slot\x00'
+        self.parts = json.dumps(marked).encode().split(b'"\\u0000slot\\u0000"')
+
+    def render(self, payload, seq=0, values=None):
+        """ Return the request body for payload's current slot values or values, with template.suffix on additionalRemittanceInfo. """
+        body = [self.parts[0]]
+        for key, part in zip(self.slots, self.parts[1:]):
+            value = values[key] if values and key in values else payload[key]
+            if self.suffix and key == 'additionalRemittanceInfo':
+                value = f'{value}{self.suffix.format(seq=seq)}'
+            body.append(json.dumps(value).encode())
+            body.append(part)
+        return b''.join(body)
+
+class PayloadStore:
+    """ Parsed json payloads of one directory with their templates, kept by file fingerprint so a reload only parses what changed. """
+
+    def __init__(self, path, workers=8):
+        self.path = path
+        self.workers = workers
+        self.entries = {}
+
+    def scan(self, value_dt=None):
+        """ Parse new or changed files in parallel, forget removed ones, and return the names which changed. """
+        found = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.endswith('json') and entry.is_file():
+                    stat = entry.stat()
+                    found[entry.name] = (stat.st_mtime_ns, stat.st_size, value_dt)
+        changed = [name for name, fingerprint in found.items() if name not in self.entries or self.entries[name][0] != fingerprint]
+        if changed:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(changed)), thread_name_prefix='payloads') as executor:
+                for name, entry in zip(changed, executor.map(self.parse, changed, [value_dt] * len(changed))):
+                    self.entries[name] = (found[name],) + entry
+        removed = [name for name in self.entries.keys() if name not in found]
+        for name in removed:
+            del self.entries[name]
+        return set(changed + removed)
+
+    def parse(self, name, value_dt):
+        """ Return the payload in file name, with valueDt applied, and its template. """
+        with open(os.path.join(self.path, name)) as f:
+            payload = json.load(f)
+        if value_dt:
+            payload["valueDt"] = str(value_dt) if '-' in name else str(value_dt).replace('-', '')
+        return payload, Template(payload)
+
+    def payloads(self, names=None):
+        """ Return a shallow copy of each payload, so fields set between loads do not leak into the parsed ones. """
+        return {name: dict(entry[1]) for name, entry in self.entries.items() if names is None or name in names}
+
+    def templates(self, names=None):
+        """ Return the template of each payload, as parsed. """
+        return {name: entry[2] for name, entry in self.entries.items() if names is None or name in names}
+
+class Corpus:
+    """ Pre-generated request bodies of one flow in a binary file, read through mmap without loading the file into memory. """
+
+    # Layout: MAGIC, header length and JSON header, bodies back to back, count + 1 body offsets, then TRAILER
+    MAGIC = b'GXPCORP1'
+    LENGTH = struct.Struct('<I')
+    OFFSETS = struct.Struct('<QQ')
+    TRAILER = struct.Struct('<QQ')
+    # Payload fields baked into the bodies which the run may have changed since the build, e.g. by 'bt', 'by', 'bn' or 'ts'
+    FIELDS = ['businessLive', 'sanctionsResponse', 'fasResponse', 'postingResponse', 'valueDt', 'sourceSystem']
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(self.MAGIC)] != self.MAGIC:
+            self.mm.close()
+            raise ValueError(f'{path} is not a payload corpus')
+        length, = self.LENGTH.unpack_from(self.mm, len(self.MAGIC))
+        start = len(self.MAGIC) + self.LENGTH.size
+        self.header = json.loads(self.mm[start:start + length])
+        self.count, self.index = self.TRAILER.unpack_from(self.mm, len(self.mm) - self.TRAILER.size)
+
+    @classmethod
+    def build(cls, path, payload, count, header):
+        """ Write count bodies of payload to path, each with its sequence number as template suffix, and return the corpus. """
+        template = Template(payload, setting('corpus', 'suffix', '_{seq}'))
+        offsets = array.array('Q')
+        encoded = json.dumps(dict(header, count=count, fields=cls.fields(payload), additionalRemittanceInfo=payload.get("additionalRemittanceInfo"))).encode()
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(cls.MAGIC + cls.LENGTH.pack(len(encoded)) + encoded)
+            for seq in range(1, count + 1):
+                offsets.append(f.tell())
+                f.write(template.render(payload, seq))
+            offsets.append(f.tell())
+            index = f.tell()
+            if sys.byteorder == 'big':
+                offsets.byteswap()
+            offsets.tofile(f)
+            f.write(cls.TRAILER.pack(count, index))
+        os.replace(f'{path}.tmp', path)
+        return cls(path)
+
+    @classmethod
+    def fields(cls, payload):
+        """ Return the FIELDS values of payload, as stored in the header. """
+        return {key: payload.get(key) for key in cls.FIELDS}
+
+    def stale(self, payload):
+        """ Return the FIELDS whose value in payload differs from the one the bodies were built with. """
+        built = self.header.get("fields", {})
+        return [key for key, value in self.fields(payload).items() if key not in built or built[key] != value]
+
+    def body(self, seq):
+        """ Return the body for transaction seq, counting from 1 and wrapping around after the last body. """
+        start, end = self.OFFSETS.unpack_from(self.mm, self.index + 8 * ((seq - 1) % self.count))
+        return self.mm[start:end]
+
+    def close(self):
+        self.mm.close()
+
+class Transaction:
+    """ Compact record of a triggered transaction, decoded once from its upload response. """
+
+    __slots__ = ('flow', 'seq', 'http_status', 'firm_root_id', 'p3_id', 'end_to_end_id', 'sent', 'latency', 'status', 'parent')
+
+    def __init__(self, flow, seq=0):
+        self.flow = flow
+        self.seq = seq
+        self.http_status = 0
+        self.firm_root_id = ''
+        self.p3_id = ''
+        self.end_to_end_id = ''
+        self.sent = 0.0
+        self.latency = 0.0
+        self.status = ''
+        self.parent = None
+
+    def update(self, response, sent, latency):
+        """ Keep the ids, HTTP status and timings of an upload response and let the response go. """
+        self.http_status = response.status_code
+        self.sent = sent
+        self.latency = latency
+        if response.status_code == 200:
+            body = response.json()
+            self.firm_root_id = body["firmRootId"] or ''
+            self.p3_id = body["p3Id"] or ''
+            self.end_to_end_id = body["endToEndId"] or ''
+        return self
+
+class Journal:
+    """ Append-only SQLite journal of every triggered transaction, written in batches by a background thread. """
+
+    COLUMNS = 'flow, seq, firm_root_id, p3_id, end_to_end_id, sent, latency, http_status, status'
+
+    def __init__(self, path):
+        self.logger = logging.getLogger('gxp-smoke')
+        self.path = path
+        self.queue = queue.Queue()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(f'CREATE TABLE IF NOT EXISTS transactions (run TEXT, {self.COLUMNS}, tran_status TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS transactions_run ON transactions (run)')
+        self.writer = threading.Thread(target=self.write, name='journal', daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        """ Return a new connection, as sqlite3 connections stay in the thread which opened them. """
+        return sqlite3.connect(self.path, timeout=30)
+
+    def append(self, run, transaction):
+        """ Queue a transaction for the writer without waiting for the disk. """
+        self.queue.put((run, transaction.flow, transaction.seq, transaction.firm_root_id, transaction.p3_id, transaction.end_to_end_id, transaction.sent, transaction.latency, transaction.http_status))
+        return self
+
+    def write(self):
+        """ Insert queued transactions, as many per commit as are waiting. """
+        connection = self.connect()
+        while True:
+            rows = [self.queue.get()]
+            while len(rows) < 10000 and not self.queue.empty():
+                rows.append(self.queue.get())
+            try:
+                with connection:
+                    connection.executemany(f'INSERT INTO transactions (run, {self.COLUMNS}, tran_status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, \'\', \'\')', rows)
+            except sqlite3.Error:
+                self.logger.exception(f'Writing {len(rows)} transactions to journal [{self.path}] failed')
+            for row in rows:
+                self.queue.task_done()
+
+    def flush(self):
+        """ Wait until every queued transaction is written. """
+        self.queue.join()
+        return self
+
+    def runs(self):
+        """ Return (run, transactions, first sent, last sent) for every run in the journal, oldest first. """
+        self.flush()
+        with closing(self.connect()) as connection:
+            return connection.execute('SELECT run, COUNT(*), MIN(sent), MAX(sent) FROM transactions GROUP BY run ORDER BY MIN(rowid)').fetchall()
+
+    def pages(self, run, size):
+        """ Yield the transactions of run as {rowid: Transaction} pages of up to size, in send order. """
+        self.flush()
+        last = 0
+        with closing(self.connect()) as connection:
+            while True:
+                rows = connection.execute(f'SELECT rowid, {self.COLUMNS} FROM transactions WHERE run = ? AND rowid > ? ORDER BY rowid LIMIT ?', (run, last, size)).fetchall()
+                if not rows:
+                    break
+                page = {}
+                for rowid, flow, seq, firm_root_id, p3_id, end_to_end_id, sent, latency, http_status, status in rows:
+                    transaction = page[rowid] = Transaction(flow, seq)
+                    transaction.firm_root_id = firm_root_id
+                    transaction.p3_id = p3_id
+                    transaction.end_to_end_id = end_to_end_id
+                    transaction.sent = sent
+                    transaction.latency = latency
+                    transaction.http_status = http_status
+                    transaction.status = json.loads(status) if status else ''
+                yield page
+                last = rows[-1][0]
+
+    def update(self, page):
+        """ Save the ids and statuses resolved for a page of transactions. """
+        rows = [(transaction.firm_root_id, transaction.p3_id, json.dumps(transaction.status) if transaction.status else '', transaction.status["tranStatus"] if transaction.status else '', rowid) for rowid, transaction in page.items()]
+        with closing(self.connect()) as connection, connection:
+            connection.executemany('UPDATE transactions SET firm_root_id = ?, p3_id = ?, status = ?, tran_status = ? WHERE rowid = ?', rows)
+        return self
+
+class IdCache:
+    """ SQLite mapping of firmRootId, p3Id and endToEndId from TransactionDetail searches, kept for ids.ttl_days so later sessions skip the search, written in batches by a background thread. """
+
+    COLUMNS = {'FIRM_ROOT_ID': 'firm_root_id', 'END_TO_END_ID': 'end_to_end_id'}
+    CHUNK = 500
+
+    def __init__(self, path, ttl):
+        self.logger = logging.getLogger('gxp-smoke')
+        self.path = path
+        self.ttl = ttl
+        self.queue = queue.Queue()
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with closing(self.connect()) as connection, connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS ids (firm_root_id TEXT PRIMARY KEY, p3_id TEXT, end_to_end_id TEXT, resolved REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ids_end_to_end_id ON ids (end_to_end_id)')
+            # Expired mappings are dropped, e.g. so ids reused after an environment refresh are searched again
+            connection.execute('DELETE FROM ids WHERE resolved < ?', (time.time() - ttl,))
+        self.writer = threading.Thread(target=self.write, name='ids', daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        """ Return a new connection, as sqlite3 connections stay in the thread which opened them. """
+        return sqlite3.connect(self.path, timeout=30)
+
+    def connection(self):
+        """ Return this thread's connection, opened on its first lookup and kept for the next ones. """
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = self.connect()
+        return self.local.connection
+
+    def get(self, ids, id_type='FIRM_ROOT_ID'):
+        """ Return TransactionDetail-like records of ids of id_type which are cached, leaving out mappings still without a p3Id. """
+        column = self.COLUMNS[id_type]
+        records = list()
+        connection = self.connection()
+        for i in range(0, len(ids), self.CHUNK):
+            chunk = ids[i:i + self.CHUNK]
+            rows = connection.execute(f'SELECT firm_root_id, p3_id, end_to_end_id FROM ids WHERE {column} IN ({", ".join("?" * len(chunk))}) AND p3_id != \'\' AND resolved >= ?', chunk + [time.time() - self.ttl])
+            records += [{"firmRootId": firm_root_id, "p3Id": p3_id, "endToEndId": end_to_end_id} for firm_root_id, p3_id, end_to_end_id in rows]
+        return records
+
+    def put(self, records):
+        """ Queue TransactionDetail records for the writer without waiting for the disk. """
+        for record in records:
+            if record.get("firmRootId"):
+                self.queue.put((record["firmRootId"], record.get("p3Id") or '', record.get("endToEndId") or '', time.time()))
+        return self
+
+    def write(self):
+        """ Store queued records, as many per commit as are waiting, keeping ids already known when a record leaves them out. """
+        connection = self.connect()
+        while True:
+            rows = [self.queue.get()]
+            while len(rows) < 10000 and not self.queue.empty():
+                rows.append(self.queue.get())
+            try:
+                with connection:
+                    connection.executemany('INSERT INTO ids VALUES (?, ?, ?, ?) ON CONFLICT (firm_root_id) DO UPDATE SET p3_id = COALESCE(NULLIF(excluded.p3_id, \'\'), p3_id), end_to_end_id = COALESCE(NULLIF(excluded.end_to_end_id, \'\'), end_to_end_id), resolved = excluded.resolved', rows)
+            except sqlite3.Error:
+                self.logger.exception(f'Writing {len(rows)} ids to cache [{self.path}] failed')
+            for row in rows:
+                self.queue.task_done()
+
+    def flush(self):
+        """ Wait until every queued record is written. """
+        self.queue.join()
+        return self
+
+    def clear(self):
+        """ Forget every cached mapping. """
+        self.flush()
+        with closing(self.connect()) as connection, connection:
+            connection.execute('DELETE FROM ids')
+        return self
+
+def nft_worker(config, payloads, plan):
+    """ Run one worker's share of an NFT plan in its own process, with its own pacing and connection pools. """
+    global args
+    args = argparse.Namespace(**config)
+    # One log file per worker next to the main one, as the progress summary keeps INFO lines off the console
+    os.makedirs(f'log/{args.endpoint["env"]}', exist_ok=True)
+    logging.basicConfig(level=plan["log_level"],
+            format='%(asctime)s %(processName)-12s %(threadName)-12s %(name)-12s %(levelname)-8s %(message)s',
+            handlers=[
+                logging.FileHandler(f'./log/{args.endpoint["env"]}/gxp-smoke-{plan["run"]}-worker-{plan["worker"]}.log'),
+                logging.StreamHandler()
+            ],
+            force=True)
+    # Each worker serves its own metrics on the ports following metrics.port
+    if setting('metrics', 'enabled', False):
+        args.metrics = dict(args.metrics, port=setting('metrics', 'port', 9464) + 1 + plan["worker"])
+    s = Smoke()
+    s.payloads = payloads
+    s.compile()
+    return s.run_plan(plan)
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    """ Agent side of a distributed NFT run: one JSON request line in, one JSON response line out. """
+
+    def handle(self):
+        """ Answer a ping, or run an NFT plan sent by the coordinator and return its results. """
+        s = self.server.smoke
+        try:
+            request = json.loads(self.rfile.readline())
+            if request["op"] == "ping":
+                response = {"time": time.time()}
+            else:
+                s.logger.info(f'Running {request["plan"]["kind"]} plan from coordinator [{self.client_address[0]}] ...')
+                s.payloads.update(request["payloads"])
+                s.compile()
+                response = s.run_nft(request["plan"])
+                s.logger.info(f'Sent {response["sent"]} transactions in {response["elapsed"]:.3f} seconds, returning results to coordinator')
+        except Exception as e:
+            s.logger.exception(f'Request from coordinator [{self.client_address[0]}] failed')
+            response = {"error": repr(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode())
 
 class Smoke:
 
     def __init__(self):
         self.payloads = {}
         self.payloads_return = {}
+        self.templates = {}
+        self.templates_return = {}
+        self.store = PayloadStore(args.payload["upload"]["json"]["main"].replace('{env}', args.endpoint["env"]))
+        self.store_return = PayloadStore(args.payload["upload"]["json"]["return"].replace('{env}', args.endpoint["env"]))
+        self.corpora = {}
+        self.scheduler = None
         self.results = {}
         self.results_return = {}
         self.logger = logging.getLogger('gxp-smoke')
@@ -24,96 +1247,140 @@ class Smoke:
         self.mock = "/".join([args.endpoint["base"], args.endpoint["mock"]])
         self.search = "/".join([args.endpoint["base"], args.endpoint["search"]]).replace('{env}', args.endpoint["env"])
         self.mocked = set()
+        self.stats = RunStats()
+        self.stats_return = RunStats()
+        self.returns_skipped = 0
+        self.lock = threading.Lock()
+        self.lag = Histogram()
+        self.intervals = []
+        self.phases = []
+        self.breakers = {endpoint: Breaker(endpoint) for endpoint in ['upload', 'mock', 'search', 'extraction']}
+        self.resilience = {}
+        self.sessions = {endpoint: self.new_session(endpoint) for endpoint in ['upload', 'mock', 'search', 'extraction']}
+        if setting('engine', 'mode', 'async') == 'async':
+            self.engine = AsyncEngine(setting('engine', 'concurrency', 256))
+        else:
+            self.engine = ThreadEngine()
+        self.tracker = Tracker(self)
+        if setting('tracker', 'enabled', False):
+            self.tracker.start()
+        self.last_run = ''
+        self.pipeline = setting('returns', 'pipeline', False)
+        self.return_after = setting('returns', 'after', [])
+        if self.pipeline and self.return_after:
+            self.tracker.start()
+        self.run = f'smoke-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}'
+        self.metrics = Metrics(self)
+        if setting('metrics', 'enabled', False):
+            self.metrics.serve(setting('metrics', 'host', '127.0.0.1'), setting('metrics', 'port', 9464))
+        self.journal = None
+        if setting('journal', 'enabled', True):
+            self.journal = Journal(setting('journal', 'path', 'smoke/{env}/journal.db').format(env=args.endpoint["env"]))
+        self.ids = None
+        if setting('ids', 'cache', True):
+            self.ids = IdCache(setting('ids', 'path', 'smoke/{env}/ids.db').format(env=args.endpoint["env"]), setting('ids', 'ttl_days', 7) * 86400)
+
+    def new_session(self, endpoint):
+        """ Return a session with its own keep-alive connection pool, sized from config, and the endpoint's retries and circuit breaker. """
+        timeouts = setting('timeout', 'endpoints', {}).get(endpoint, {})
+        session = ResilientSession(self.breakers[endpoint], (timeouts.get("connect", setting('timeout', 'connect', 5)), timeouts.get("read", setting('timeout', 'read', 60))))
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=setting('session', 'pool_connections', 10),
+            pool_maxsize=setting('session', 'pool_size', setting('engine', 'concurrency', 256)),
+            pool_block=setting('session', 'pool_block', False))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not setting('session', 'keep_alive', True):
+            session.headers['Connection'] = 'close'
+        return session
+
+    def fan_out(self, target, calls):
+        """ Run target(*call) for every call on the engine and wait for all of them to finish. """
+        wait([self.engine.submit(target, *call) for call in calls])
+        return self
 
     def load(self):
-        """ Load json payloads """
-        path_main = args.payload["upload"]["json"]["main"].replace('{env}', args.endpoint["env"])
-        path_return = args.payload["upload"]["json"]["return"].replace('{env}', args.endpoint["env"])
+        """ Load json payloads, parsing only the files which are new or changed since the last load """
+        path_main = self.store.path
+        path_return = self.store_return.path
         self.logger.info(f'Loading json payloads from directory: [{path_main}] ...')
-        flows = [f for f in os.listdir(path_main) if f.endswith('json')]
-        returns = [f for f in os.listdir(path_return) if f.endswith('json')]
-        self.payloads = {}
-        for flow in flows:
-            # Load main payload
-            with open("/".join([path_main, flow])) as payload:
-                self.payloads[flow] = json.loads(payload.read())
-            # Load return payload if exists
-            if flow in returns:
-                with open("/".join([path_return, flow])) as payload:
-                    self.payloads_return[flow] = json.loads(payload.read())
-        if args.payload["upload"]["valueDt"]:
-            self.update_value_date()
+        start = perf_counter()
+        value_dt = args.payload["upload"]["valueDt"]
+        changed = self.store.scan(value_dt)
+        changed_return = self.store_return.scan(value_dt)
+        # Fresh copies undo fields set since the last load, e.g. businessLive or sourceSystem, as re-reading every file did
+        self.payloads = self.store.payloads()
+        self.payloads_return = self.store_return.payloads(self.payloads.keys())
+        self.templates = self.store.templates()
+        self.templates_return = self.store_return.templates(self.payloads.keys())
+        self.logger.info(f'Parsed {len(changed)} new or changed payloads from {path_main} and {len(changed_return)} from {path_return} in {perf_counter() - start:.3f} s')
         self.logger.info(f'Loaded {len(self.payloads)} payloads from {path_main}: {self.payloads.keys()}')
         self.logger.info(f'Loaded {len(self.payloads_return)} payloads from {path_return}: {self.payloads_return.keys()}')
         return self
 
-    def update_value_date(self):
-        """ Update value date. """
-        for payload in self.payloads.keys():
-            if '-' in payload:
-                self.payloads[payload]["valueDt"] = str(args.payload["upload"]["valueDt"])
-                if payload in self.payloads_return.keys():
-                    self.payloads_return[payload]["valueDt"] = str(args.payload["upload"]["valueDt"])
-            else:
-                self.payloads[payload]["valueDt"] = str(args.payload["upload"]["valueDt"]).replace('-', '')
-                if payload in self.payloads_return.keys():
-                    self.payloads_return[payload]["valueDt"] = str(args.payload["upload"]["valueDt"]).replace('-', '')
+    def compile(self):
+        """ Pre-encode self.payloads into templates. Call again after changing a field which is not a template slot. """
+        self.templates = {flow: Template(payload) for flow, payload in self.payloads.items()}
+        self.templates_return = {flow: Template(payload) for flow, payload in self.payloads_return.items()}
         return self
 
+    def template(self, flow, returned=False):
+        """ Return the template for flow or its return flow, recompiling it if fields were added to the payload since. """
+        templates, payloads = (self.templates_return, self.payloads_return) if returned else (self.templates, self.payloads)
+        template = templates.get(flow)
+        if template is None or template.size != len(payloads[flow]):
+            template = templates[flow] = Template(payloads[flow])
+        return template
+
     def smokes(self):
         """ Run smoke test for all flows in self.payloads """
         self.logger.info(f'Triggering smoke tests on {args.endpoint["env"].upper()} for all flows ...')
+        self.run = f'smoke-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}'
         self.results = {}
         self.results_return = {}
-        threads = list()
+        calls = list()
         for flow in self.payloads.keys():
-            t = threading.Thread(target=self.smoke_thread, args=(0, flow))
-            threads.append(t)
-            t.start()
-        for index, thread in enumerate(threads):
-            thread.join()
+            calls.append((0, flow))
+        self.fan_out(self.smoke_thread, calls)
+        # Pipelined returns were submitted by the parents, so results are complete before 'r' or 'sv'
+        self.engine.drain()
         return self
 
     def smokes_return(self):
         """ Trigger return flows. """
         self.logger.info(f'Triggering smoke tests on {args.endpoint["env"].upper()} for return flows ...')
-        threads = list()
+        calls = list()
         for flow, result in self.results.items():
             if flow in self.payloads_return.keys():
                 # Get parent_firm_root_id and parent_p3_id
-                parent_firm_root_id = result["response"].json()["firmRootId"]
-                parent_p3_id = result["response"].json()["p3Id"]
-                end_to_end_id = result["response"].json()["endToEndId"]
+                parent_firm_root_id = result.firm_root_id
+                parent_p3_id = result.p3_id
+                end_to_end_id = result.end_to_end_id
                 # Update payload
                 self.payloads_return[flow]["parentFirmRootId"] = parent_firm_root_id
                 self.payloads_return[flow]["parentP3Id"] = parent_p3_id
                 self.payloads_return[flow]["endToEndId"] = end_to_end_id
-                t = threading.Thread(target=self.smoke_return_thread, args=(0, flow))
-                threads.append(t)
-                t.start()
-        for index, thread in enumerate(threads):
-            thread.join()
+                calls.append((0, flow))
+        self.fan_out(self.smoke_return_thread, calls)
         return
 
     def update(self):
         """ Run smoke test for all incomplete flows in self.payloads """
         self.logger.info(f'Triggering smoke test on {args.endpoint["env"].upper()} for incomplete flows ...')
-        threads = list()
+        calls = list()
         for flow in self.payloads.keys():
-            if flow not in self.results.keys() or 'status' not in self.results[flow].keys() or self.results[flow]['status']['tranStatus'] not in ['CMP', 'RTN']:
-                t = threading.Thread(target=self.smoke_thread, args=(0, flow))
-                threads.append(t)
-                t.start()
-        for index, thread in enumerate(threads):
-            thread.join()
+            if flow not in self.results.keys() or not self.results[flow].status or self.results[flow].status['tranStatus'] not in ['CMP', 'RTN']:
+                calls.append((0, flow))
+        self.fan_out(self.smoke_thread, calls)
+        # Pipelined returns were submitted by the parents, so results are complete before 'r' or 'sv'
+        self.engine.drain()
         return self
 
     def smoke(self, flow):
         """ Run smoke test for a given flow. """
-        url = self.upload.replace('{service}', 'payment')
         if flow in self.payloads.keys():
             # Reset results
-            self.results[flow] = {}
+            self.results[flow] = Transaction(flow)
 
             # Update payloads
             if flow in self.mocked:
@@ -133,10 +1400,10 @@ class Smoke:
                 self.payloads[flow]["postingResponse"] = ''
 
             # Request
-            self.results[flow]["response"] = requests.post(url, data=json.dumps(self.payloads[flow]), headers=self.headers)
+            self.send_upload(self.results[flow], self.payloads[flow])
 
             # Response
-            if self.results[flow]["response"].status_code == 200:
+            if self.results[flow].http_status == 200:
                 self.logger.info(f'Request for [{flow}] was successful, id = {self.get_id(flow)["id"]}')
             else:
                 self.logger.warning(f'Request for [{flow}] was unsuccessful')
@@ -144,15 +1411,41 @@ class Smoke:
             self.logger.error(f'[{flow}] not found.')
         return self
 
+    def send_upload(self, transaction, payload, stats=None, planned=None):
+        """ Post a payload dict or pre-encoded body to the upload endpoint and record the response on transaction, and in stats or self.stats. """
+        stats = stats or self.stats
+        url = self.upload.replace('{service}', 'payment')
+        sent = time.time()
+        # NFT latency runs from the planned send time, so time queued in a saturated client is not hidden
+        start = perf_counter() if planned is None else planned
+        if planned is not None:
+            self.scheduler.sent(planned)
+        try:
+            response = self.sessions['upload'].post(url, data=payload if isinstance(payload, bytes) else json.dumps(payload), headers=self.headers)
+        except requests.RequestException as e:
+            # Calls refused by an open breaker were never sent, so they only count by status
+            status, latency = ('OPEN', None) if isinstance(e, CircuitOpen) else ('ERR', perf_counter() - start)
+            stats.record(latency, status)
+            self.metrics.record(latency, status)
+            raise
+        stats.record(perf_counter() - start, response.status_code)
+        self.metrics.record(perf_counter() - start, response.status_code)
+        transaction.update(response, sent, perf_counter() - start)
+        if self.journal:
+            self.journal.append(self.run, transaction)
+        if self.tracker.running:
+            self.tracker.track(transaction)
+        return transaction
+
     def get_id(self, flow):
         """ Returns firmRootId or endToEndId for a given flow result. """
         result = {"id": "Not found", "type": "NA"}
         if flow in self.results.keys():
-            if self.results[flow]["response"].json()["firmRootId"]:
-                result["id"] = self.results[flow]["response"].json()["firmRootId"]
+            if self.results[flow].firm_root_id:
+                result["id"] = self.results[flow].firm_root_id
                 result["type"] = "FIRM_ROOT_ID"
-            elif self.results[flow]["response"].json()["endToEndId"]:
-                result["id"] = self.results[flow]["response"].json()["endToEndId"]
+            elif self.results[flow].end_to_end_id:
+                result["id"] = self.results[flow].end_to_end_id
                 result["type"] = "END_TO_END_ID"
         return result
 
@@ -160,74 +1453,131 @@ class Smoke:
         """ Returns firmRootId or endToEndId for a given return flow result. """
         result = {"id": "Not found", "type": "NA"}
         if flow in self.results_return.keys():
-            if self.results_return[flow]["response"].json()["firmRootId"]:
-                result["id"] = self.results_return[flow]["response"].json()["firmRootId"]
+            if self.results_return[flow].firm_root_id:
+                result["id"] = self.results_return[flow].firm_root_id
                 result["type"] = "FIRM_ROOT_ID"
-            elif self.results_return[flow]["response"].json()["endToEndId"]:
-                result["id"] = self.results_return[flow]["response"].json()["endToEndId"]
+            elif self.results_return[flow].end_to_end_id:
+                result["id"] = self.results_return[flow].end_to_end_id
                 result["type"] = "END_TO_END_ID"
         return result
 
     def get_transaction_status(self, firm_root_id):
         """ Get transaction status by firmRootId. """
         url = self.search.replace('{region}', 'TransactionStatus').replace('{ids}', firm_root_id)
-        response = requests.get(url)
+        response = self.sessions['search'].get(url)
         if response.status_code == 200 and len(response.json()) != 0:
             return response.json()[0]
         return ""
 
+    def search_many(self, region, ids, id_type='FIRM_ROOT_ID'):
+        """ Return search records for ids, packing up to batch.search_size ids into each query. """
+        size = setting('batch', 'search_size', 50)
+        calls = list()
+        records = list()
+        for i in range(0, len(ids), size):
+            calls.append((region, ids[i:i + size], id_type, records))
+        self.fan_out(self.search_thread, calls)
+        return records
+
+    def search_thread(self, region, ids, id_type, records):
+        """ Search a region for a chunk of ids and add the records found to records. """
+        separator = setting('batch', 'search_separator', ',')
+        url = self.search.replace('{region}', region).replace('{ids}', separator.join(ids)).replace('FIRM_ROOT_ID', id_type)
+        response = self.sessions['search'].get(url)
+        if response.status_code == 200:
+            records.extend(response.json())
+        else:
+            self.logger.warning(f'Search on {region} for {len(ids)} ids was unsuccessful')
+        return self
+
+    def details(self, ids, id_type='FIRM_ROOT_ID'):
+        """ Return TransactionDetail records for ids, from the id cache where already resolved and searched in bulk otherwise. """
+        records = self.ids.get(ids, id_type) if self.ids else []
+        found = {record[{"FIRM_ROOT_ID": "firmRootId", "END_TO_END_ID": "endToEndId"}[id_type]] for record in records}
+        searched = self.search_many('TransactionDetail', [i for i in ids if i not in found], id_type)
+        if self.ids and searched:
+            self.ids.put(searched)
+        self.logger.debug(f'Resolved {len(records)} of {len(ids)} ids from the id cache')
+        return records + searched
+
+    def resolve(self, *results):
+        """ Fill in firm_root_id, p3_id and status for all flows in results with bulk searches. """
+        entries = [result for flows in results for result in flows.values() if result.http_status == 200]
+
+        # firmRootId by endToEndId for flows which did not return a firmRootId on upload
+        self.resolve_firm_root_ids(entries)
+
+        # p3Id by firmRootId
+        by_firm_root_id = {entry.firm_root_id: entry for entry in entries if entry.firm_root_id}
+        missing = [firm_root_id for firm_root_id, entry in by_firm_root_id.items() if not entry.p3_id]
+        for record in self.details(missing):
+            if record["firmRootId"] in by_firm_root_id:
+                by_firm_root_id[record["firmRootId"]].p3_id = record["p3Id"]
+
+        # Status by firmRootId
+        for record in self.search_many('TransactionStatus', list(by_firm_root_id.keys())):
+            if record["firmRootId"] in by_firm_root_id:
+                by_firm_root_id[record["firmRootId"]].status = record
+        return self
+
+    def resolve_firm_root_ids(self, entries):
+        """ Fill in firm_root_id, and p3_id where known, of entries which only returned an endToEndId on upload, with bulk searches. """
+        by_end_to_end_id = {entry.end_to_end_id: entry for entry in entries if not entry.firm_root_id and entry.end_to_end_id}
+        for record in self.details(list(by_end_to_end_id.keys()), 'END_TO_END_ID'):
+            if record["endToEndId"] in by_end_to_end_id:
+                by_end_to_end_id[record["endToEndId"]].firm_root_id = record["firmRootId"]
+                by_end_to_end_id[record["endToEndId"]].p3_id = record["p3Id"] or by_end_to_end_id[record["endToEndId"]].p3_id
+        return self
+
     def get_name(self, flow):
         """ Return formatted name of flow. 'flow' is the name of the payload json file. """
         return " ".join(flow[:-5].split('_')).upper()
 
     def get_firm_root_id(self, flow, results):
         """ Get firm_root_id from self.results by flow. """
-        if results[flow]["response"].json()["firmRootId"]:
-            return results[flow]["response"].json()["firmRootId"]
-        elif 'firm_root_id' in results[flow] and results[flow]["firm_root_id"]:
-            return results[flow]["firm_root_id"]
-        else:
-            url = self.search.replace('{region}', 'TransactionDetail').replace('{ids}', self.results[flow]["response"].json()["endToEndId"]).replace('FIRM_ROOT_ID', 'END_TO_END_ID')
-            response = requests.get(url)
+        if results[flow].firm_root_id:
+            return results[flow].firm_root_id
+        elif results[flow].end_to_end_id:
+            cached = self.ids.get([results[flow].end_to_end_id], 'END_TO_END_ID') if self.ids else []
+            if cached:
+                results[flow].firm_root_id = cached[0]["firmRootId"]
+                results[flow].p3_id = results[flow].p3_id or cached[0]["p3Id"]
+                return results[flow].firm_root_id
+            url = self.search.replace('{region}', 'TransactionDetail').replace('{ids}', results[flow].end_to_end_id).replace('FIRM_ROOT_ID', 'END_TO_END_ID')
+            response = self.sessions['search'].get(url)
             if response.status_code == 200 and len(response.json()) != 0:
-                results[flow]["firm_root_id"] = response.json()[0]["firmRootId"]
-                return results[flow]["firm_root_id"]
+                results[flow].firm_root_id = response.json()[0]["firmRootId"]
+                if self.ids:
+                    self.ids.put(response.json()[:1])
+                return results[flow].firm_root_id
         return ""
 
     def get_p3_id(self, flow, results):
         """ Get p3_id from results by flow. """
-        if results[flow]["response"].json()["p3Id"]:
-            return results[flow]["response"].json()["p3Id"]
-        elif 'p3_id' in results[flow] and results[flow]["p3_id"]:
-            return results[flow]["p3_id"]
-        else:
-            url = self.search.replace('{region}', 'TransactionDetail').replace('{ids}', results[flow]["firm_root_id"])
-            response = requests.get(url)
+        if results[flow].p3_id:
+            return results[flow].p3_id
+        elif self.get_firm_root_id(flow, results):
+            if results[flow].p3_id:
+                return results[flow].p3_id
+            cached = self.ids.get([results[flow].firm_root_id]) if self.ids else []
+            if cached:
+                results[flow].p3_id = cached[0]["p3Id"]
+                return results[flow].p3_id
+            url = self.search.replace('{region}', 'TransactionDetail').replace('{ids}', results[flow].firm_root_id)
+            response = self.sessions['search'].get(url)
             if response.status_code == 200 and len(response.json()) != 0:
-                results[flow]["p3_id"] = response.json()[0]["p3Id"]
-                return results[flow]["p3_id"]
+                results[flow].p3_id = response.json()[0]["p3Id"]
+                if self.ids:
+                    self.ids.put(response.json()[:1])
+                return results[flow].p3_id
         return ""
 
     def report_2(self, verbose, update_returns=False):
         """ Print report of smoke test in self.results """
         self.logger.info(f'Updating statuses and p3_id ...')
 
-        # Update main results
-        threads = list()
-        for flow in self.results.keys():
-            t = threading.Thread(target=self.update_result, args=(0, flow, self.results))
-            threads.append(t)
-            t.start()
-
-        # Update return results
-        for flow in self.results_return.keys():
-            t = threading.Thread(target=self.update_result, args=(0, flow, self.results_return))
-            threads.append(t)
-            t.start()
-
-        # Join threads
-        for index, thread in enumerate(threads):
-            thread.join()
+        # Update main and return results in bulk
+        self.resolve(self.results, self.results_return)
 
         # Print results
         self.logger.info(f'Printing test report ...')
@@ -235,14 +1585,14 @@ class Smoke:
         for flow, result in sorted(self.results.items()):
             if update_returns and flow in self.results_return.keys():
                 name = self.get_name(flow)
-                firm_root_id = self.get_firm_root_id(flow, self.results_return)
-                p3_id = self.get_p3_id(flow, self.results_return)
-                status = self.results_return[flow]["status"]
+                firm_root_id = self.results_return[flow].firm_root_id
+                p3_id = self.results_return[flow].p3_id
+                status = self.results_return[flow].status
             else:
                 name = self.get_name(flow)
-                firm_root_id = self.get_firm_root_id(flow, self.results)
-                p3_id = self.get_p3_id(flow, self.results)
-                status = result["status"]
+                firm_root_id = result.firm_root_id
+                p3_id = result.p3_id
+                status = result.status
             if verbose:
                 print(f'{name}: {firm_root_id} / {p3_id} - {self.get_service_statuses(status)}{self.get_business_live_n_text(flow)}')
             elif status != '':
@@ -254,37 +1604,154 @@ class Smoke:
 
         return self
 
+    def watch(self):
+        """ Poll unfinished flows and print status changes until every flow is terminal or watch.timeout passes. """
+        timeout = setting('watch', 'timeout', 600)
+        interval = setting('watch', 'interval', 2)
+        watched = {}
+        for suffix, results in [('', self.results), (' (RETURN)', self.results_return)]:
+            for flow, result in results.items():
+                if result.http_status == 200:
+                    watched[f'{self.get_name(flow)}{suffix}'] = (flow, result)
+        last = {name: None for name in watched.keys()}
+        self.logger.info(f'Watching {len(watched)} flows until tranStatus is one of {self.tracker.terminal} ...')
+        print(f'\n[Watching on {time.ctime().upper()} - {args.endpoint["env"]}]\n'.upper())
+        deadline = perf_counter() + timeout
+        pending = {name: result for name, (flow, result) in watched.items() if not result.status or result.status["tranStatus"] not in self.tracker.terminal}
+        while True:
+            if pending:
+                self.resolve(pending)
+
+            # One snapshot per poll for both printing and the settled check, as the tracker thread updates the same statuses
+            snapshot = {name: dict(result.status) if result.status else '' for name, (flow, result) in watched.items()}
+
+            # Print transitions only
+            for name, (flow, result) in sorted(watched.items()):
+                statuses = self.get_service_statuses(snapshot[name])
+                if statuses != last[name]:
+                    last[name] = statuses
+                    print(f'{time.strftime("%H:%M:%S")} {name}: {result.firm_root_id} / {result.p3_id} - {statuses}{self.get_business_live_n_text(flow)}')
+
+            pending = {name: watched[name][1] for name, status in snapshot.items() if not status or status["tranStatus"] not in self.tracker.terminal}
+            if not pending:
+                print(f'\n[All {len(watched)} flows settled]\n'.upper())
+                break
+            if perf_counter() > deadline:
+                print(f'\n[Timed out after {timeout} seconds, not settled: {", ".join(sorted(pending))}]\n'.upper())
+                break
+            time.sleep(interval)
+        return self
+
+    def journal_run(self):
+        """ Prompt for a run in the journal, the last one by default. """
+        runs = self.journal.runs()
+        for run, count, first, last in runs:
+            print(f'{run} \t{count} transactions \t{time.ctime(first)} - {time.ctime(last)}')
+        if not runs:
+            print(f'No transactions in journal [{self.journal.path}]')
+            return None
+        print(f'Which run? (Enter for \'{runs[-1][0]}\')')
+        run = input()
+        return run or runs[-1][0]
+
+    def journal_report(self, run):
+        """ Resolve statuses of every transaction of a journal run page by page, save them and print counts by flow and tranStatus. """
+        size = setting('journal', 'page_size', 1000)
+        counts = {}
+        file_name = f'gxp-journal-{run}-{datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}.log'
+        self.logger.info(f'Updating statuses of journal run [{run}] ...')
+        with open(f'smoke/{args.endpoint["env"]}/{file_name}', 'w') as f:
+            f.write(f'[Journal {run} on {time.ctime().upper()} - {args.endpoint["env"]}]\n'.upper())
+            for page in self.journal.pages(run, size):
+                self.resolve(page)
+                self.journal.update(page)
+                for transaction in page.values():
+                    tran_status = transaction.status["tranStatus"] if transaction.status else (transaction.http_status if transaction.http_status != 200 else 'NOT FOUND')
+                    counts.setdefault(transaction.flow, {}).setdefault(tran_status, 0)
+                    counts[transaction.flow][tran_status] += 1
+                    f.write(f'\n{self.get_name(transaction.flow)} #{transaction.seq}: {transaction.firm_root_id or transaction.end_to_end_id} / {transaction.p3_id} - {self.get_service_statuses(transaction.status)}')
+            f.write(f'\n\n[END]\n')
+        print(f'\n[Journal {run} on {time.ctime().upper()} - {args.endpoint["env"]}]\n'.upper())
+        for flow, statuses in sorted(counts.items()):
+            print(f'{self.get_name(flow)}: {sum(statuses.values())} - ' + ', '.join(f'{status} = {count}' for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))))
+        print(f'\n[END]\n')
+        self.logger.info(f'Journal report saved to [smoke/{args.endpoint["env"]}/{file_name}]')
+        return self
+
+    def journal_mock(self, run, service, response_value):
+        """ Mock a service response for every unsettled transaction of a journal run, page by page. """
+        size = setting('journal', 'page_size', 1000)
+        mocked = 0
+        for page in self.journal.pages(run, size):
+            self.resolve(page)
+            self.journal.update(page)
+            pending = [transaction for transaction in page.values() if transaction.firm_root_id and (not transaction.status or transaction.status["tranStatus"] not in self.tracker.terminal)]
+            chunk = setting('batch', 'mock_size', 100)
+            self.fan_out(self.mock_transactions_thread, [(service, [(response_value, transaction) for transaction in pending[i:i + chunk]]) for i in range(0, len(pending), chunk)])
+            mocked += len(pending)
+        self.logger.info(f'Mocked {service} with {response_value.upper()} for {mocked} transactions of journal run [{run}]')
+        return self
+
+    def mock_transactions_thread(self, service, items):
+        """ Mock a service response for a chunk of (response_value, transaction) items in one request, and log success or failure per transaction. """
+        url = self.mock.replace('{service}', service)
+        response_key = f'{args.payload["mock"][service]["key"]}'
+
+        # Transactions whose firmRootId never resolved cannot be mocked, so they fail without being sent
+        unresolved = [transaction for response_value, transaction in items if not transaction.firm_root_id]
+        if unresolved:
+            self.logger.warning(f'Mock of {service} failed for {len(unresolved)} transactions without a firmRootId: {[f"{transaction.flow} ({transaction.end_to_end_id})" for transaction in unresolved]}')
+            self.tracker.unmock(service, unresolved)
+        items = [(response_value, transaction) for response_value, transaction in items if transaction.firm_root_id]
+        if not items:
+            return self
+
+        payload = [{"firmRootId": transaction.firm_root_id, response_key: response_value, "clearingSystem": self.get_clearing_system(transaction.flow)} for response_value, transaction in items]
+        mocked = [f'{transaction.flow}: {response_value.upper()} ({transaction.firm_root_id})' for response_value, transaction in items]
+        try:
+            response = self.sessions['mock'].post(url, data=json.dumps(payload), headers=self.headers)
+        except requests.RequestException:
+            self.tracker.unmock(service, [transaction for response_value, transaction in items])
+            raise
+        if response.status_code != 200:
+            self.logger.warning(f'Batched mock of {service} for {len(items)} transactions failed with HTTP {response.status_code}: {mocked}')
+            self.tracker.unmock(service, [transaction for response_value, transaction in items])
+            return self
+
+        # Items echoed in the response are matched per firmRootId, a response without them only tells the batch was accepted
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if not isinstance(body, list):
+            self.logger.info(f'Batched mock of {service} for {len(items)} transactions returned HTTP 200 without listing them: {mocked}')
+            return self
+        echoed = {item.get("firmRootId") for item in body if isinstance(item, dict)}
+        failed = [(response_value, transaction) for response_value, transaction in items if transaction.firm_root_id not in echoed]
+        succeeded = [f'{transaction.flow}: {response_value.upper()} ({transaction.firm_root_id})' for response_value, transaction in items if transaction.firm_root_id in echoed]
+        if succeeded:
+            self.logger.info(f'Mock of {service} succeeded for {len(succeeded)} transactions: {succeeded}')
+        if failed:
+            self.logger.warning(f'Mock of {service} failed for {len(failed)} transactions missing from the response: {[f"{transaction.flow}: {response_value.upper()} ({transaction.firm_root_id})" for response_value, transaction in failed]}')
+            self.tracker.unmock(service, [transaction for response_value, transaction in failed])
+        return self
+
     def save(self):
         """ Save smoke test result to log file """
         file_name = f'gxp-smoke-test-{datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}.log'
+        self.resolve(self.results)
         with open(f'smoke/{args.endpoint["env"]}/{file_name}', 'w') as f:
             f.write(f'[Smoke test on {time.ctime().upper()} - {args.endpoint["env"]}]\n'.upper())
             for flow, result in sorted(self.results.items()):
                 name = self.get_name(flow)
-                firm_root_id = self.get_firm_root_id(flow, self.results)
-                p3_id = self.get_p3_id(flow, self.results)
-                status = result["status"]
+                firm_root_id = result.firm_root_id
+                p3_id = result.p3_id
+                status = result.status
                 f.write(f'\n{name}: {firm_root_id} / {p3_id} - {self.get_service_statuses(status)}{self.get_business_live_n_text(flow)}')
             f.write(f'\n\n[END]\n')
             self.logger.info(f'Smoke test result saved to [smoke/{args.endpoint["env"]}/{file_name}]')
         return self
 
-    def update_result(self, name, flow, results):
-        """ Get transaction status and p3Id of flow. """
-        if flow in results.keys():
-            # Update firm_root_id
-            if 'firm_root_id' not in results[flow].keys():
-                results[flow]["firm_root_id"] = self.get_firm_root_id(flow, results)
-
-            # Update status
-            results[flow]["status"] = self.get_transaction_status(results[flow]["firm_root_id"])
-
-            # Update p3_id
-            if 'p3_id' not in results[flow].keys():
-                results[flow]["p3_id"] = self.get_p3_id(flow, results)
-
-        return self
-
     def get_business_live_n_text(self, flow):
         """ Return business live n text if transaction was triggered with isBusinessLive as 'N'. """
         if flow in self.mocked:
@@ -319,7 +1786,7 @@ class Smoke:
             firm_root_id = self.get_firm_root_id(flow, results)
             response_key = f'{args.payload["mock"][service]["key"]}'
             payload = {"firmRootId": firm_root_id, response_key: response_value, "clearingSystem": self.get_clearing_system(flow)}
-            response = requests.post(url, data=json.dumps([payload]), headers=self.headers)
+            response = self.sessions['mock'].post(url, data=json.dumps([payload]), headers=self.headers)
             if response.status_code == 200:
                 self.logger.info(f'Mocking {service} with {response_value.upper()} for [{flow}] was successful, firmRootId = {firm_root_id}')
             else:
@@ -328,178 +1795,185 @@ class Smoke:
             self.logger.error(f'[{flow}] not found')
         return self
 
+    def mock_calls(self, calls):
+        """ Send (service, response_value, flow, results) mock calls, batched per service if configured. """
+        if not setting('batch', 'mock', False):
+            return self.fan_out(self.mock_thread, calls)
+
+        # firmRootIds of endToEndId-only flows in bulk, instead of one search per item in each batch
+        self.resolve_firm_root_ids([results[flow] for service, response_value, flow, results in calls if flow in results])
+
+        # Group main and return transactions by service, then chunk each service's list
+        size = setting('batch', 'mock_size', 100)
+        services = {}
+        for service, response_value, flow, results in calls:
+            if flow in results:
+                services.setdefault(service, []).append((response_value, results[flow]))
+        chunks = list()
+        for service, items in services.items():
+            for i in range(0, len(items), size):
+                chunks.append((service, items[i:i + size]))
+        self.logger.info(f'Sending {len(calls)} mocks in {len(chunks)} batched requests ...')
+        return self.fan_out(self.mock_transactions_thread, chunks)
+
+    def mock_response(self, service, flow, returned=False):
+        """ Return the response to mock for a service and flow, with debit and credit swapped for return flows. """
+        debit = bool(args.debit) and flow in args.debit
+        if returned:
+            debit = not debit
+        if service == 'sanctions':
+            return "FAILED_REJECT" if args.sanctions_reject and flow in args.sanctions_reject else "PASSED"
+        elif service == 'fundcontrol':
+            return "dr:rq:yes" if debit else "cr:rq:yes"
+        elif service == 'posting':
+            return "dr:dda:ack" if debit else "cr:dda:ack"
+        return "Technical Ack, Settlement Ack"
+
+    def automock(self, mocks):
+        """ Send the mock each (service, transaction) waits for, batched per service, as seen by the tracker. """
+        services = {}
+        for service, transaction in mocks:
+            if 'book' in transaction.flow and service in ['fundcontrol', 'posting']:
+                response_value = "cr:rq:ack" if service == 'fundcontrol' else "cr:dda:ack"
+            else:
+                response_value = self.mock_response(service, transaction.flow, transaction.parent is not None or self.results_return.get(transaction.flow) is transaction)
+            services.setdefault(service, []).append((response_value, transaction))
+        size = setting('batch', 'mock_size', 100)
+        self.fan_out(self.mock_transactions_thread, [(service, items[i:i + size]) for service, items in services.items() for i in range(0, len(items), size)])
+        return self
+
+    def toggle_automock(self):
+        """ Switch auto-mocking on or off, tracking the current results so they are mocked too. """
+        self.tracker.automock = not self.tracker.automock
+        if self.tracker.automock:
+            self.tracker.start()
+            for results in [self.results, self.results_return]:
+                for result in results.values():
+                    if not result.status or result.status["tranStatus"] not in self.tracker.terminal:
+                        self.tracker.track(result)
+            self.logger.info(f'Auto-mocking is on for {sorted(self.mocked)}')
+        else:
+            self.logger.info(f'Auto-mocking is off')
+        return self
+
     def mock_sanctions(self):
         """ Mock sanctions for all transactions. """
         self.logger.info(f'Mocking sanctions for all transactions ...')
-        response_value = ''
-        threads = list()
+        calls = list()
         # Main
         for flow in self.results.keys():
-            response_value = "FAILED_REJECT" if args.sanctions_reject and flow in args.sanctions_reject else "PASSED"
-            t = threading.Thread(target=self.mock_thread, args=('sanctions', response_value, flow, self.results))
-            threads.append(t)
-            t.start()
+            calls.append(('sanctions', self.mock_response('sanctions', flow), flow, self.results))
         # Return
         for flow in self.results_return.keys():
-            response_value = "FAILED_REJECT" if args.sanctions_reject and flow in args.sanctions_reject else "PASSED"
-            t = threading.Thread(target=self.mock_thread, args=('sanctions', response_value, flow, self.results_return))
-            threads.append(t)
-            t.start()
+            calls.append(('sanctions', self.mock_response('sanctions', flow, returned=True), flow, self.results_return))
         # Join
-        for index, thread in enumerate(threads):
-            thread.join()
+        self.mock_calls(calls)
         return self
 
     def mock_funds(self):
         """ Mock funds for all transactions. """
         self.logger.info(f'Mocking funds for all transactions ...')
-        response_value = ''
-        threads = list()
+        calls = list()
         # Main
         for flow in self.results.keys():
-            response_value = "dr:rq:yes" if args.debit and flow in args.debit else "cr:rq:yes"
-            t = threading.Thread(target=self.mock_thread, args=('fundcontrol', response_value, flow, self.results))
-            threads.append(t)
-            t.start()
+            calls.append(('fundcontrol', self.mock_response('fundcontrol', flow), flow, self.results))
         # Return
         for flow in self.results_return.keys():
-            response_value = "cr:rq:yes" if args.debit and flow in args.debit else "dr:rq:yes"
-            t = threading.Thread(target=self.mock_thread, args=('fundcontrol', response_value, flow, self.results_return))
-            threads.append(t)
-            t.start()
+            calls.append(('fundcontrol', self.mock_response('fundcontrol', flow, returned=True), flow, self.results_return))
         # Join
-        for index, thread in enumerate(threads):
-            thread.join()
+        self.mock_calls(calls)
         return self
 
     def mock_posting(self):
         """ Mock posting for all transactions. """
         self.logger.info(f'Mocking posting for all transactions ...')
-        response_value = ''
-        threads = list()
+        calls = list()
         # Main
         for flow in self.results.keys():
-            response_value = "dr:dda:ack" if args.debit and flow in args.debit else "cr:dda:ack"
-            t = threading.Thread(target=self.mock_thread, args=('posting', response_value, flow, self.results))
-            threads.append(t)
-            t.start()
+            calls.append(('posting', self.mock_response('posting', flow), flow, self.results))
         # Return
         for flow in self.results_return.keys():
-            response_value = "cr:dda:ack" if args.debit and flow in args.debit else "dr:dda:ack"
-            t = threading.Thread(target=self.mock_thread, args=('posting', response_value, flow, self.results_return))
-            threads.append(t)
-            t.start()
+            calls.append(('posting', self.mock_response('posting', flow, returned=True), flow, self.results_return))
         # Join
-        for index, thread in enumerate(threads):
-            thread.join()
+        self.mock_calls(calls)
         return self
 
     def mock_funds_book(self):
         """ Mock funds as 'Credit Req Ack' for all book transactions. """
         self.logger.info(f'Mocking funds for all book transactions ...')
         response_value = ''
-        threads = list()
+        calls = list()
         for flow in self.results.keys():
             if 'book' in flow:
                 response_value = "cr:rq:ack"
-                t = threading.Thread(target=self.mock_thread, args=('fundcontrol', response_value, flow, self.results))
-                threads.append(t)
-                t.start()
-        for index, thread in enumerate(threads):
-            thread.join()
+                calls.append(('fundcontrol', response_value, flow, self.results))
+        self.mock_calls(calls)
         return self
 
     def mock_posting_book(self):
         """ Mock posting as 'Credit DDA Ack' for all book transactions. """
         self.logger.info(f'Mocking posting for all book transactions ...')
         response_value = ''
-        threads = list()
+        calls = list()
         for flow in self.results.keys():
             if 'book' in flow:
                 response_value = "cr:dda:ack"
-                t = threading.Thread(target=self.mock_thread, args=('posting', response_value, flow, self.results))
-                threads.append(t)
-                t.start()
-        for index, thread in enumerate(threads):
-            thread.join()
+                calls.append(('posting', response_value, flow, self.results))
+        self.mock_calls(calls)
         return self
 
     def mock_clearing(self):
         """ Mock clearing for all transactions. """
         self.logger.info(f'Mocking clearing for all transactions ...')
-        response_value = ''
-        threads = list()
+        calls = list()
         # Main
         for flow in self.results.keys():
-            response_value = "Technical Ack, Settlement Ack"
-            t = threading.Thread(target=self.mock_thread, args=('clearing', response_value, flow, self.results))
-            threads.append(t)
-            t.start()
+            calls.append(('clearing', self.mock_response('clearing', flow), flow, self.results))
         # Return
         for flow in self.results_return.keys():
-            response_value = "Technical Ack, Settlement Ack"
-            t = threading.Thread(target=self.mock_thread, args=('clearing', response_value, flow, self.results_return))
-            threads.append(t)
-            t.start()
+            calls.append(('clearing', self.mock_response('clearing', flow, returned=True), flow, self.results_return))
         # Join
-        for index, thread in enumerate(threads):
-            thread.join()
+        self.mock_calls(calls)
         return self
 
-    def extraction(self, tps, mins):
-        """ Trigger extraction bulk for a given TPS and duration in mins. """
-        seconds = mins * 60
-        num_transactions = tps * mins * 60
-        self.logger.info(f'Triggering {num_transactions} extraction bulk with {tps} transactions per second for {mins} ...')
-
-        # Wait until 200 ms before the 0th second
-        current_milliseconds = int(time.time() * 1000) % 1000
-        while current_milliseconds < 800:
-            current_milliseconds = int(time.time() * 1000) % 1000
+    def extraction(self, tps, mins, profile=None):
+        """ Trigger extraction bulk for a given TPS and duration in mins, or following a load profile from config. """
+        plan = self.profile_plan({"kind": "extraction", "flow": "extraction_bulk", "tps": tps, "mins": mins}, profile)
+        num_transactions = plan["transactions"]
+        self.logger.info(f'Triggering {num_transactions} extraction bulk with {plan["load"]} ...')
 
         # Start triggering
-        start = perf_counter()
-        for j in range(seconds):
-
-            # Wait until the 0th second
-            current_milliseconds = int(time.time() * 1000) % 1000
-            while current_milliseconds > 50:
-                current_milliseconds = int(time.time() * 1000) % 1000
-
-            # Spawn threads
-            self.logger.info(f'Triggering {tps} transactions at {time.ctime()}')
-            for i in range(tps):
-                t = threading.Thread(target=self.extraction_thread, args=(j*tps+i+1,'extraction_bulk'))
-                t.start()
+        execution_time = self.run_nft(plan)["drained"]
 
-                # Sleep awhile to space out requests
-                time.sleep(0.05)
-
-            # Sleep for 50 milliseconds
-            time.sleep(0.05)
-
-        t.join()
-        end = perf_counter()
-        execution_time = (end - start)
-
-        # Compute performance
+        # Compute performance from completed responses until the last one came back, as dispatches always keep to the plan
         execution_minutes = execution_time // 60
         execution_seconds = execution_time % 60
-        mean_tps = num_transactions / execution_time
+        mean_tps = self.stats.latency.total / execution_time
 
-        # Sleep for awhile
-        time.sleep(3)
-
-        self.logger.info(f'Triggered {num_transactions} extraction bulk in [{execution_minutes} mins {execution_seconds} seconds] ({execution_time} seconds)')
+        self.logger.info(f'Completed {self.stats.latency.total}/{num_transactions} extraction bulk in [{execution_minutes} mins {execution_seconds} seconds] ({execution_time} seconds)')
         self.logger.info(f'Mean TPS (transactions per second): {mean_tps}')
+        self.save_stats('extraction_bulk', plan["load"])
         return self
 
-    def extraction_thread(self, name, flow):
+    def extraction_thread(self, name, flow, stats=None, planned=None):
         """ Extraction thread """
         url = args.endpoint["extraction"]
+        stats = stats or self.stats
 
-        # Post request
-        response = requests.post(url, headers=self.headers)
+        # Post request, timed from the planned send time as in send_upload
+        start = perf_counter() if planned is None else planned
+        if planned is not None:
+            self.scheduler.sent(planned)
+        try:
+            response = self.sessions['extraction'].post(url, headers=self.headers)
+        except requests.RequestException as e:
+            # Calls refused by an open breaker were never sent, so they only count by status
+            status, latency = ('OPEN', None) if isinstance(e, CircuitOpen) else ('ERR', perf_counter() - start)
+            stats.record(latency, status)
+            self.metrics.record(latency, status)
+            raise
+        stats.record(perf_counter() - start, response.status_code)
+        self.metrics.record(perf_counter() - start, response.status_code)
 
         # Response
         if response.status_code == 200:
@@ -509,59 +1983,347 @@ class Smoke:
 
         return self
 
-    def industry(self, flow, tps, mins):
-        """ Trigger flow for a given TPS and duration in mins. """
-        seconds = mins * 60
-        num_transactions = tps * mins * 60
-        additionalRemittanceInfo = self.payloads[flow]["additionalRemittanceInfo"]
-        self.logger.info(f'Triggering {num_transactions} [{flow}] with {tps} transactions per second for {mins} minutes using additionalRemittanceInfo as [{additionalRemittanceInfo}]...')
-
-        # Wait until 200 ms before the 0th second
-        current_milliseconds = int(time.time() * 1000) % 1000
-        while current_milliseconds < 800:
-            current_milliseconds = int(time.time() * 1000) % 1000
+    def industry(self, flow, tps, mins, profile=None):
+        """ Trigger flow for a given TPS and duration in mins, or following a load profile from config. """
+        plan = self.profile_plan({"kind": "industry", "flow": flow, "tps": tps, "mins": mins}, profile)
+        num_transactions = plan["transactions"]
+        # Bodies replayed from a corpus carry the value it was built with
+        additionalRemittanceInfo = self.replayed_remittance_info(flow) or self.payloads[flow]["additionalRemittanceInfo"]
+        self.logger.info(f'Triggering {num_transactions} [{flow}] with {plan["load"]} using additionalRemittanceInfo as [{additionalRemittanceInfo}]...')
 
         # Start triggering
-        start = perf_counter()
-        for j in range(seconds):
+        execution_time = self.run_nft(plan)["drained"]
 
-            # Wait until the 0th second
-            current_milliseconds = int(time.time() * 1000) % 1000
-            while current_milliseconds > 50:
-                current_milliseconds = int(time.time() * 1000) % 1000
-
-            # Spawn threads
-            self.logger.info(f'Triggering {tps} transactions at {time.ctime()}')
-            for i in range(tps):
-                t = threading.Thread(target=self.smoke_thread, args=(j*tps+i+1, flow))
-                t.start()
-
-                # Sleep awhile to space out requests
-                time.sleep(0.02)
-
-            # Sleep for 50 milliseconds
-            time.sleep(0.05)
-
-        t.join()
-        end = perf_counter()
-        execution_time = (end - start)
-
-        # Compute performance
+        # Compute performance from completed responses until the last one came back, as dispatches always keep to the plan
         execution_minutes = execution_time // 60
         execution_seconds = execution_time % 60
-        mean_tps = num_transactions / execution_time
-
-        # Sleep for awhile
-        time.sleep(3)
+        mean_tps = self.stats.latency.total / execution_time
 
-        self.logger.info(f'Triggered {num_transactions} [{flow}] in [{execution_minutes} mins {execution_seconds} seconds] ({execution_time} seconds)')
+        self.logger.info(f'Completed {self.stats.latency.total}/{num_transactions} [{flow}] in [{execution_minutes} mins {execution_seconds} seconds] ({execution_time} seconds)')
         self.logger.info(f'Mean TPS (transactions per second): {mean_tps}')
+        self.save_stats(flow, plan["load"])
         return self
 
-    def smoke_thread(self, name, flow):
+    def saturate(self, flow):
+        """ Find the highest TPS of flow within the saturation SLOs, doubling from saturation.start and then bisecting, and save the curve. """
+        start = setting('saturation', 'start', 10)
+        highest = setting('saturation', 'max', 5000)
+        precision = setting('saturation', 'precision', 5)
+        self.logger.info(f'Searching for the highest TPS of [{flow}] within SLOs {setting("saturation", "slo", {})}, starting at {start} TPS ...')
+
+        # Double until the SLOs are missed, then bisect between the last pass and the first miss
+        curve = {}
+        passed, failed = 0, None
+        tps = start
+        while tps not in curve:
+            curve[tps] = self.probe(flow, tps)
+            if curve[tps]["pass"]:
+                passed = max(passed, tps)
+            else:
+                failed = min(failed or tps, tps)
+            if failed is None:
+                tps = min(tps * 2, highest)
+            elif failed - passed > precision:
+                tps = (passed + failed) // 2
+            if tps not in curve:
+                time.sleep(setting('saturation', 'cooldown', 10))
+
+        # Report every probe in TPS order
+        lines = [f'[NFT SATURATION {self.get_name(flow)} on {time.ctime().upper()} - {args.endpoint["env"]}]'.upper(), '']
+        lines.append(f'SLOs: {setting("saturation", "slo", {})}, {setting("saturation", "secs", 60)} seconds per probe')
+        for tps, probe in sorted(curve.items()):
+            lines.append(f'{tps} TPS: {"pass" if probe["pass"] else "FAIL"} - achieved = {probe["achieved"]:.1f} TPS, p99 = {probe["p99"] * 1000:.3f} ms, errors = {probe["errors"]}/{probe["sent"]}' + (f', e2e p99 = {probe["e2e_p99"] * 1000:.3f} ms, e2e timed out = {probe["timed_out"]}' if "e2e_p99" in probe else '') + (f' ({", ".join(probe["missed"])})' if probe["missed"] else ''))
+        lines += ['', f'Highest TPS within SLOs: {passed}' + (' (saturation.max reached)' if failed is None else f' (missed at {failed} TPS)')]
+        print('\n' + '\n'.join(lines) + '\n\n[END]\n')
+        file_name = f'gxp-nft-saturation-{flow[:-5]}-{datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}.log'
+        with open(f'smoke/{args.endpoint["env"]}/{file_name}', 'w') as f:
+            f.write('\n'.join(lines) + '\n\n[END]\n')
+            self.logger.info(f'Saturation curve saved to [smoke/{args.endpoint["env"]}/{file_name}]')
+        return passed
+
+    def probe(self, flow, tps):
+        """ Run flow at a flat TPS for saturation.secs and check the results against the saturation SLOs. """
+        slo = setting('saturation', 'slo', {})
+        seconds = setting('saturation', 'secs', 60)
+        self.logger.info(f'Probing [{flow}] at {tps} TPS for {seconds} seconds ...')
+        result = self.run_nft({"kind": "industry", "flow": flow, "phases": [{"shape": "flat", "from": tps, "to": tps, "seconds": seconds, "label": f'{tps} TPS'}]})
+        # Achieved TPS counts completed responses until the last one came back, as dispatches always keep to the plan
+        probe = {"sent": self.stats.total(), "errors": self.stats.errors(), "p99": self.stats.latency.percentile(99), "achieved": self.stats.latency.total / max(result["drained"], seconds), "missed": []}
+        if probe["achieved"] < tps * slo.get("throughput", 0.95):
+            probe["missed"].append('throughput')
+        if probe["errors"] > probe["sent"] * slo.get("error_rate", 0.01):
+            probe["missed"].append('error rate')
+        if probe["p99"] > slo.get("p99", 1.0):
+            probe["missed"].append('p99')
+        if slo.get("e2e_p99") and self.tracker.running:
+            probe["e2e_p99"] = self.tracker.latency.percentile(99)
+            probe["timed_out"] = self.tracker.timed_out
+            if probe["e2e_p99"] > slo["e2e_p99"] or probe["timed_out"]:
+                probe["missed"].append('e2e p99')
+        probe["pass"] = not probe["missed"]
+        self.logger.info(f'{tps} TPS {"is within SLOs" if probe["pass"] else "missed " + ", ".join(probe["missed"])}: achieved = {probe["achieved"]:.1f} TPS, p99 = {probe["p99"] * 1000:.3f} ms, errors = {probe["errors"]}/{probe["sent"]}')
+        return probe
+
+    def profile_plan(self, plan, profile=None):
+        """ Add the phases of a load profile in config profiles to a plan, with its number of transactions and description. """
+        if profile:
+            plan["phases"] = Scheduler.expand(args.profiles[profile])
+            plan["transactions"] = Scheduler.starts(plan["phases"])[1]
+            plan["load"] = f'profile {profile} for {sum(phase["seconds"] for phase in plan["phases"]) / 60:g} mins'
+        else:
+            plan["transactions"] = plan["tps"] * plan["mins"] * 60
+            plan["load"] = f'{plan["tps"]} TPS for {plan["mins"]} mins'
+        return plan
+
+    def run_nft(self, plan):
+        """ Run an NFT plan in this process, or split across nft.processes worker processes, and merge the results. """
+        processes = setting('nft', 'processes', 1)
+        plan.setdefault("track", self.tracker.running)
+        plan.setdefault("run", f'{plan["kind"]}-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}')
+        plan.setdefault("pipeline", self.pipeline)
+        plan.setdefault("returns", {flow: self.payloads_return[flow] for flow in self.plan_flows(plan) if flow in self.payloads_return} if self.pipeline else {})
+        if processes <= 1:
+            return self.merge_results([self.run_plan(plan)], remote=False)
+
+        # Workers start together, each sending every processes-th transaction of this plan's share
+        self.logger.info(f'Splitting {plan["kind"]} plan across {processes} worker processes ...')
+        plans = list()
+        index = plan.get("index", 0)
+        count = plan.get("count", 1)
+        start_at = plan.get("start_at") or math.ceil(time.time()) + setting('nft', 'startup', 3)
+        for worker in range(processes):
+            plans.append(dict(plan, index=index + count * worker, count=count * processes, start_at=start_at, log_level=self.logger.getEffectiveLevel(), worker=worker))
+        payloads = {flow: self.payloads[flow] for flow in self.plan_flows(plan)}
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = list(executor.map(nft_worker, [vars(args)] * processes, [payloads] * processes, plans))
+        return self.merge_results(results)
+
+    def coordinate(self, plan):
+        """ Run an NFT plan split across the agents in distributed.agents, starting together, and merge their results. """
+        agents = setting('distributed', 'agents', [])
+        if not agents:
+            self.logger.error(f'No agents configured in distributed.agents')
+            return None
+
+        # Check every agent is up and warn about clock skew, as agents start on wall-clock time
+        for agent in agents:
+            skew = self.agent_request(agent, {"op": "ping"})["time"] - time.time()
+            self.logger.info(f'Agent [{agent}] is ready, clock skew = {skew * 1000:.1f} ms')
+            if abs(skew) > 0.1:
+                self.logger.warning(f'Clock of agent [{agent}] is off by {skew:.3f} seconds, sync clocks for an aligned start')
+
+        # Each agent sends every len(agents)-th transaction from a common start
+        plan["track"] = self.tracker.running
+        plan["run"] = f'{plan["kind"]}-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}'
+        plan["pipeline"] = self.pipeline
+        plan["returns"] = {flow: self.payloads_return[flow] for flow in self.plan_flows(plan) if flow in self.payloads_return} if self.pipeline else {}
+        start_at = math.ceil(time.time()) + setting('nft', 'startup', 3)
+        payloads = {flow: self.payloads[flow] for flow in self.plan_flows(plan)}
+        calls = list()
+        for index, agent in enumerate(agents):
+            calls.append((agent, {"op": "run", "plan": dict(plan, index=index, count=len(agents), start_at=start_at), "payloads": payloads}))
+        self.logger.info(f'Sending {plan["kind"]} plan to {len(agents)} agents, starting at {time.ctime(start_at)} ...')
+        with ThreadPoolExecutor(max_workers=len(agents)) as executor:
+            results = list(executor.map(lambda call: self.agent_request(*call), calls))
+        for agent, result in zip(agents, results):
+            self.logger.info(f'Agent [{agent}] sent {result["sent"]} transactions in {result["elapsed"]:.3f} seconds with {RunStats.from_dict(result["stats"]).errors()} errors')
+        return self.merge_results(results)
+
+    def agent_request(self, agent, request):
+        """ Send one JSON request line to an agent at host:port and return its JSON response line. """
+        host, port = agent.rsplit(':', 1)
+        with socket.create_connection((host, int(port)), timeout=setting('distributed', 'connect_timeout', 10)) as sock:
+            sock.settimeout(None)
+            sock.sendall((json.dumps(request) + '\n').encode())
+            response = json.loads(sock.makefile('rb').readline())
+        if "error" in response:
+            raise RuntimeError(f'Agent [{agent}] failed: {response["error"]}')
+        return response
+
+    def run_plan(self, plan):
+        """ Run this process's share of an NFT plan and return its counts and latencies as plain dicts. """
+        self.stats = RunStats()
+        self.stats_return = RunStats()
+        self.returns_skipped = 0
+        for breaker in self.breakers.values():
+            breaker.reset()
+        self.pipeline = plan.get("pipeline", self.pipeline)
+        self.payloads_return.update(plan.get("returns", {}))
+        self.tracker.reset()
+        if plan["track"]:
+            self.tracker.start()
+        run = self.run
+        self.run = plan["run"]
+        index = plan.get("index", 0)
+        count = plan.get("count", 1)
+        target = self.extraction_thread if plan["kind"] == "extraction" else self.smoke_thread
+        flows = self.plan_flows(plan) or [plan["flow"]]
+        # Soak intervals and profile phases keep their own stats, merged into self.stats at the end
+        if plan["kind"] == "soak":
+            per_interval = plan["tpi"] * len(flows)
+            intervals = [RunStats() for i in range(math.ceil(plan["mins"] / plan["mpi"]))]
+            starts = [i * per_interval for i in range(len(intervals))]
+            transactions = per_interval * len(intervals)
+            offsets = Scheduler.intervals(per_interval, plan["mpi"] * 60, len(intervals), index, count)
+        elif plan.get("phases"):
+            intervals = [RunStats() for phase in plan["phases"]]
+            starts, transactions = Scheduler.starts(plan["phases"])
+            offsets = Scheduler.profile(plan["phases"], index, count)
+        else:
+            intervals = []
+            starts = []
+            transactions = plan["tps"] * plan["mins"] * 60
+            offsets = Scheduler.constant(plan["tps"], plan["mins"] * 60, index, count)
+        self.corpora = self.open_corpora(flows, transactions) if plan["kind"] == "industry" else {}
+        def dispatch(seq, planned):
+            number = index + (seq - 1) * count
+            interval = bisect.bisect_right(starts, number) - 1
+            if intervals and number - starts[interval] < count:
+                self.logger.info(f'Triggering {"phase " + plan["phases"][interval]["label"] if plan.get("phases") else "interval"} {interval + 1}/{len(intervals)} at {time.ctime()}')
+            self.engine.submit(target, number + 1, flows[number % len(flows)], intervals[interval] if intervals else None, planned)
+        scheduler = self.scheduler = Scheduler()
+        self.metrics.start(plan["kind"], math.ceil((transactions - index) / count), scheduler, f'[worker {plan["worker"]}] ' if "worker" in plan else '', plan.get("start_at"))
+        try:
+            scheduler.run(offsets, dispatch, plan.get("start_at"))
+            self.engine.drain()
+            drained = perf_counter() - scheduler.start
+            for corpus in self.corpora.values():
+                corpus.close()
+            self.corpora = {}
+            for stats in intervals:
+                self.stats.merge(stats)
+            if self.tracker.running:
+                self.tracker.wait()
+        finally:
+            self.metrics.stop()
+        if self.journal:
+            self.journal.flush()
+        if self.ids:
+            self.ids.flush()
+        self.run = run
+        # Extraction requests are not journalled
+        return {"run": plan["run"] if plan["kind"] != "extraction" else '', "sent": scheduler.lag.total, "elapsed": scheduler.elapsed(), "drained": drained, "stats": self.stats.to_dict(), "lag": scheduler.lag.to_dict(), "tracker": self.tracker.to_dict(), "intervals": [stats.to_dict() for stats in intervals], "phases": plan.get("phases", []), "returns": self.stats_return.to_dict(), "returns_skipped": self.returns_skipped, "resilience": {endpoint: dict(breaker.counts) for endpoint, breaker in self.breakers.items()}}
+
+    def corpus_path(self, flow):
+        """ Return the corpus file of flow under corpus.path. """
+        path = setting('corpus', 'path', 'smoke/{env}/corpus').format(env=args.endpoint["env"])
+        return f'{path}/{flow[:-5] if flow.endswith(".json") else flow}.bin'
+
+    def build_corpus(self, flow, count):
+        """ Pre-generate count unique request bodies of flow into its corpus file, for industry to replay with corpus.enabled. """
+        path = self.corpus_path(flow)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.logger.info(f'Building corpus of {count} bodies for [{flow}] in [{path}] ...')
+        start = perf_counter()
+        corpus = Corpus.build(path, self.payloads[flow], count, {"flow": flow, "env": args.endpoint["env"], "built": time.ctime()})
+        self.logger.info(f'Built corpus for [{flow}] in {perf_counter() - start:.3f} seconds ({os.path.getsize(path) / 1048576:.1f} MB)')
+        corpus.close()
+        return self
+
+    def open_corpora(self, flows, transactions):
+        """ Return the corpora of flows when corpus.enabled, warning when a corpus is missing, stale or smaller than the run. """
+        corpora = {}
+        if not setting('corpus', 'enabled', False):
+            return corpora
+        for flow in flows:
+            path = self.corpus_path(flow)
+            if not os.path.exists(path):
+                self.logger.warning(f'No corpus for [{flow}] in [{path}], rendering bodies from the payload instead')
+                continue
+            corpus = Corpus(path)
+            stale = corpus.stale(self.payloads[flow])
+            if stale:
+                self.logger.warning(f'Corpus for [{flow}] in [{path}] was built with other {", ".join(stale)} than the payload, rendering bodies from the payload instead (rebuild it with \'cb\')')
+                corpus.close()
+                continue
+            corpora[flow] = corpus
+            self.logger.info(f'Sending [{flow}] bodies from corpus [{path}] built {corpora[flow].header["built"]} ({corpora[flow].count} bodies) with additionalRemittanceInfo as [{corpora[flow].header["additionalRemittanceInfo"]}]')
+            if corpora[flow].count < transactions:
+                self.logger.warning(f'Corpus for [{flow}] has {corpora[flow].count} bodies for {transactions} transactions, bodies will repeat')
+        return corpora
+
+    def replayed_remittance_info(self, flow):
+        """ Return the additionalRemittanceInfo of the corpus an NFT run would replay for flow, or None when bodies are rendered from the payload. """
+        path = self.corpus_path(flow)
+        if not setting('corpus', 'enabled', False) or not os.path.exists(path):
+            return None
+        corpus = Corpus(path)
+        replayed = None if corpus.stale(self.payloads[flow]) else corpus.header.get("additionalRemittanceInfo")
+        corpus.close()
+        return replayed
+
+    def plan_flows(self, plan):
+        """ Return the payload flows an NFT plan sends. """
+        if plan["kind"] == "soak":
+            return plan["flows"]
+        elif plan["kind"] == "industry":
+            return [plan["flow"]]
+        return []
+
+    def merge_results(self, results, remote=True):
+        """ Merge run_plan results into self.stats, self.lag and, for results from other processes, the tracker. """
+        self.stats = RunStats()
+        self.stats_return = RunStats()
+        self.resilience = {}
+        self.lag = Histogram()
+        self.intervals = [RunStats() for stats in results[0]["intervals"]]
+        self.phases = results[0]["phases"]
+        for result in results:
+            self.stats.merge(RunStats.from_dict(result["stats"]))
+            self.stats_return.merge(RunStats.from_dict(result["returns"]))
+            for endpoint, counts in result["resilience"].items():
+                merged = self.resilience.setdefault(endpoint, dict.fromkeys(counts.keys(), 0))
+                for key, count in counts.items():
+                    merged[key] += count
+            self.lag.merge(Histogram.from_dict(result["lag"]))
+            for interval, stats in zip(self.intervals, result["intervals"]):
+                interval.merge(RunStats.from_dict(stats))
+        if remote:
+            self.tracker.reset()
+            for result in results:
+                self.tracker.merge(result["tracker"])
+        sent = sum(result["sent"] for result in results)
+        elapsed = max(result["elapsed"] for result in results)
+        drained = max(result["drained"] for result in results)
+        self.returns_skipped = sum(result["returns_skipped"] for result in results)
+        self.last_run = results[0]["run"]
+        return {"run": results[0]["run"], "sent": sent, "elapsed": elapsed, "drained": drained, "stats": self.stats.to_dict(), "lag": self.lag.to_dict(), "tracker": self.tracker.to_dict(), "intervals": [stats.to_dict() for stats in self.intervals], "phases": self.phases, "returns": self.stats_return.to_dict(), "returns_skipped": self.returns_skipped, "resilience": self.resilience}
+
+    def save_stats(self, flow, load):
+        """ Print latency and error summary of an NFT run and save it next to the smoke test results. """
+        name = self.get_name(flow) if flow.endswith('.json') else flow
+        lines = [f'[NFT {name} on {time.ctime().upper()} - {args.endpoint["env"]} - {load}]'.upper(), '']
+        if self.journal and self.last_run:
+            lines.append(f'Journal: run [{self.last_run}] in [{self.journal.path}]')
+        lines += self.stats.summary()
+        lines.append(f'Send lag (actual - planned send time): {self.lag.summary()}, late (> 10 ms) = {self.lag.count_above(0.01)}/{self.lag.total}')
+        if self.stats_return.latency.total:
+            lines += [f'Returns {line}' for line in self.stats_return.summary()]
+        if self.returns_skipped:
+            lines.append(f'Returns skipped (parent firmRootId or p3Id not resolved): {self.returns_skipped}')
+        # Retries and short-circuited calls tell client-caused load apart from errors returned by GXP
+        for endpoint, counts in self.resilience.items():
+            if any(counts.values()):
+                lines.append(f'Resilience [{endpoint}]: retries = {counts["retries"]}, retry budget exhausted = {counts["exhausted"]}, breaker trips = {counts["trips"]}, short-circuited (OPEN) = {counts["rejected"]}')
+        for interval, stats in enumerate(self.intervals, 1):
+            if self.phases:
+                phase = self.phases[interval - 1]
+                lines.append(f'Phase {interval} ({phase["label"]} for {phase["seconds"]} seconds): {stats.latency.summary()}, errors = {stats.errors()}, achieved = {stats.latency.total / phase["seconds"]:.1f} TPS')
+            else:
+                lines.append(f'Interval {interval}: {stats.latency.summary()}, errors = {stats.errors()}')
+        if self.tracker.running and (self.tracker.completed or self.tracker.timed_out):
+            lines += self.tracker.summary()
+        print('\n' + '\n'.join(lines) + '\n\n[END]\n')
+        file_name = f'gxp-nft-{flow[:-5] if flow.endswith(".json") else flow}-{datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}.log'
+        with open(f'smoke/{args.endpoint["env"]}/{file_name}', 'w') as f:
+            f.write('\n'.join(lines) + '\n\n[END]\n')
+            self.logger.info(f'NFT result saved to [smoke/{args.endpoint["env"]}/{file_name}]')
+        return self
+
+    def smoke_thread(self, name, flow, stats=None, planned=None):
         """ Smoke thread """
-        url = self.upload.replace('{service}', 'payment')
-        self.results[flow] = {}
+        transaction = Transaction(flow, name)
+        self.results[flow] = transaction
 
         # Update payloads
         # if flow in self.mocked:
@@ -581,19 +2343,31 @@ class Smoke:
         #     self.payloads[flow]["postingResponse"] = ''
 
         # Request
-        self.results[flow]["response"] = requests.post(url, data=json.dumps(self.payloads[flow]), headers=self.headers)
-
-        # Response
-        if self.results[flow]["response"].status_code == 200:
-            self.logger.info(f'Request for [{flow}] was successful, id = {self.get_id(flow)["id"]}')
+        corpus = self.corpora.get(flow)
+        self.send_upload(transaction, corpus.body(name) if corpus else self.template(flow).render(self.payloads[flow], name), stats, planned)
+
+        # Response, read from this thread's transaction as concurrent NFT threads replace self.results[flow]
+        if transaction.http_status == 200:
+            self.logger.info(f'Request for [{flow}] was successful, id = {transaction.firm_root_id or transaction.end_to_end_id}')
+            # Pipelined return right away, or from the tracker once the parent reaches returns.after
+            if self.pipeline and flow in self.payloads_return and not self.return_after:
+                self.engine.submit(self.smoke_return_thread, name, flow, transaction)
         else:
             self.logger.warning(f'Request for [{flow}] was unsuccessful')
         return self
 
-    def smoke_return_thread(self, name, flow):
-        """ Smoke return thread """
-        url = self.upload.replace('{service}', 'payment')
-        self.results_return[flow] = {}
+    def smoke_return_thread(self, name, flow, parent=None):
+        """ Smoke return thread, for the parent ids set in self.payloads_return by smokes_return or for a pipelined parent. """
+        # A pipelined return is only sent once GXP has given the parent both ids, e.g. p3Id is null in the upload response
+        if parent:
+            ids = {"parentFirmRootId": self.get_firm_root_id(flow, {flow: parent}), "parentP3Id": self.get_p3_id(flow, {flow: parent}), "endToEndId": parent.end_to_end_id}
+            if not ids["parentFirmRootId"] or not ids["parentP3Id"]:
+                with self.lock:
+                    self.returns_skipped += 1
+                self.logger.warning(f'Return for [{flow}] skipped, parent ids not resolved yet: parent_firm_root_id = {ids["parentFirmRootId"]}, parent_p3_id = {ids["parentP3Id"]}, end_to_end_id = {ids["endToEndId"]}')
+                return self
+        transaction = Transaction(flow, name)
+        self.results_return[flow] = transaction
 
         # Update payloads
         if flow in self.mocked:
@@ -612,16 +2386,29 @@ class Smoke:
             self.payloads_return[flow]["fasResponse"] = ''
             self.payloads_return[flow]["postingResponse"] = ''
 
-        # Request
-        self.results_return[flow]["response"] = requests.post(url, data=json.dumps(self.payloads_return[flow]), headers=self.headers)
+        # Request, with a pipelined parent's ids rendered into the body as concurrent returns share self.payloads_return[flow]
+        if parent:
+            transaction.parent = parent
+            self.send_upload(transaction, self.template(flow, returned=True).render(self.payloads_return[flow], name, ids), self.stats_return)
+        else:
+            ids = self.payloads_return[flow]
+            self.send_upload(transaction, self.payloads_return[flow])
 
         # Response
-        if self.results_return[flow]["response"].status_code == 200:
-            self.logger.info(f'Request for [{flow}] was successful, id = {self.get_return_id(flow)["id"]}, parent_firm_root_id = {self.payloads_return[flow]["parentFirmRootId"]}, parent_p3_id = {self.payloads_return[flow]["parentP3Id"]}, end_to_end_id = {self.payloads_return[flow]["endToEndId"]}')
+        if transaction.http_status == 200:
+            self.logger.info(f'Request for [{flow}] was successful, id = {transaction.firm_root_id or transaction.end_to_end_id}, parent_firm_root_id = {ids["parentFirmRootId"]}, parent_p3_id = {ids["parentP3Id"]}, end_to_end_id = {ids["endToEndId"]}')
         else:
             self.logger.warning(f'Request for [{flow}] was unsuccessful')
         return self
 
+    def toggle_pipeline(self):
+        """ Switch pipelined return flows on or off. """
+        self.pipeline = not self.pipeline
+        if self.pipeline and self.return_after:
+            self.tracker.start()
+        self.logger.info(f'Pipelined returns are {"on" if self.pipeline else "off"}' + (f', sent once the parent tranStatus is one of {self.return_after}' if self.pipeline and self.return_after else ''))
+        return self
+
     def toggle_source_system(self):
         """ Toggle source system for incoming transactions. """
         for flow in self.payloads.keys():
@@ -632,6 +2419,7 @@ class Smoke:
                 else:
                     self.payloads[flow]["sourceSystem"] = 'gc2'
                     self.logger.info(f'Source system for {[flow]} is now set to [gc2]')
+        self.compile()
         return self
 
     def reset_additional_remittance_info(self):
@@ -640,54 +2428,33 @@ class Smoke:
             s.payloads[flow]["additionalRemittanceInfo"] = 'Additional Remittance Info'
         return self
 
-    def soak(self, tpi, mpi, mins, unstrucRemitInfo1):
-        """ Soak test."""
-        seconds = mins * 60
-        num_transactions = tpi * (mins / mpi)
-        self.logger.info(f'Triggering {num_transactions} [sgp_irct_dmct.json, sgp_iddt_pmdd.json] with {tpi} transactions each every {mpi} mins for {mins} mins using unstructRemitInfo1 as [{unstrucRemitInfo1}] ...')
+    def soak(self, flows, tpi, mpi, mins, unstrucRemitInfo1):
+        """ Soak test: tpi transactions of each flow every mpi mins for mins, fired on fixed wall-clock ticks. """
+        intervals = math.ceil(mins / mpi)
+        num_transactions = tpi * len(flows) * intervals
+        self.logger.info(f'Triggering {num_transactions} {flows} with {tpi} transactions each every {mpi} mins for {mins} mins using unstructRemitInfo1 as [{unstrucRemitInfo1}] ...')
 
         # Set unstrucRemitInfo
-        self.payloads["sgp_irct_dmct.json"]["additionalRemittanceInfo"] = unstrucRemitInfo1
-        self.payloads["sgp_iddt_pmdd.json"]["additionalRemittanceInfo"] = unstrucRemitInfo1
+        for flow in flows:
+            self.payloads[flow]["additionalRemittanceInfo"] = unstrucRemitInfo1
 
         # Start triggering
-        start = perf_counter()
-        while True:
+        execution_time = self.run_nft({"kind": "soak", "flows": flows, "tpi": tpi, "mpi": mpi, "mins": mins})["elapsed"]
 
-            # Trigger transactions
-            self.logger.info(f'Triggering {tpi * 2} transactions at {time.ctime()}')
-            t = threading.Thread(target=self.smoke_thread, args=(0, 'sgp_irct_dmct.json'))
-            t.start()
-            t = threading.Thread(target=self.smoke_thread, args=(0, 'sgp_irct_dmct.json'))
-            t.start()
-            t = threading.Thread(target=self.smoke_thread, args=(0, 'sgp_iddt_pmdd.json'))
-            t.start()
-            t = threading.Thread(target=self.smoke_thread, args=(0, 'sgp_iddt_pmdd.json'))
-            t.start()
-
-            # Sleep for interval
-            self.logger.info(f'Sleeping for {mpi} mins ...')
-            time.sleep(60 * mpi)
-
-        t.join()
-        end = perf_counter()
-        execution_time = (end - start)
-
-        # Computer performance
+        # Compute performance
         execution_minutes = execution_time // 60
         execution_seconds = execution_time % 60
-        mean_tpe = num_transactions / execution_time
-
-        # Sleep for awhile
-        time.sleep(3)
 
+        self.logger.info(f'Triggered {num_transactions} {flows} in {intervals} intervals in [{execution_minutes} mins {execution_seconds} seconds] ({execution_time} seconds)')
+        self.save_stats('soak', f'{tpi} TPI every {mpi} mins for {mins} mins')
         return self
 
 if __name__ == '__main__':
     # argparse
     parser = argparse.ArgumentParser(description='Use GXP Smoke to run smoke tests and generate report.')
     parser.add_argument('-y', '--yaml', type=str, help='(Deprecated) name of yaml config file')
-    parser.add_argument('-e', '--env', type=str, default='ua1', help='environment to trigger smoke tests on. Possible values are: dev, qa1, qa2, ua1, ua2, ua3, ua4, perf')
+    parser.add_argument('-e', '--env', type=str, default='ua1', help='environment to trigger smoke tests on. Possible values are: dev, qa1, qa2, ua1, ua2, ua3, ua4, perf, local')
+    parser.add_argument('-a', '--agent', type=str, help='run as an NFT agent listening on [host:]port for plans from a coordinator, instead of the interactive prompt')
     args = parser.parse_args()
 
     # Load config based on -y or --yaml flag
@@ -728,6 +2495,14 @@ if __name__ == '__main__':
     s = Smoke()
     s.load()
 
+    # agent
+    if args.agent:
+        host, port = args.agent.rsplit(':', 1) if ':' in args.agent else ('0.0.0.0', args.agent)
+        server = socketserver.TCPServer((host, int(port)), AgentHandler)
+        server.smoke = s
+        s.logger.info(f'Agent listening on {host}:{port} for NFT plans ...')
+        server.serve_forever()
+
     # report
     x = ''
     while x != 'q' and x != 'quit':
@@ -766,7 +2541,7 @@ if __name__ == '__main__':
                     flows = set(str(input().replace("'", '')).split(' '))
                 for flow in flows:
                     name = s.get_name(flow)
-                    firm_root_id = s.results[flow].json()["firmRootId"]
+                    firm_root_id = s.get_firm_root_id(flow, s.results)
                     p3_id = s.get_p3_id(flow, s.results)
                     status = s.get_transaction_status(firm_root_id)
                     if status != '':
@@ -851,29 +2626,109 @@ if __name__ == '__main__':
                     print(f'Which flow would you like to trigger continuously?')
                     print(f'{s.payloads.keys()}')
                     flow = input()
-                print(f'How many transactions per second?')
-                tps = int(input())
-                print(f'For how many minutes?')
-                mins = int(input())
+                print(f'How many transactions per second? (or a load profile: {list((getattr(args, "profiles", None) or {}).keys())})')
+                tps = input()
+                profile = tps if tps in (getattr(args, 'profiles', None) or {}) else None
+                tps = 0 if profile else int(tps)
+                mins = 0
+                if not profile:
+                    print(f'For how many minutes?')
+                    mins = int(input())
+
+                # Update unstrucRemitInfo for post analysis, unless the bodies come from a corpus which already carries one
+                replayed = s.replayed_remittance_info(flow)
+                if replayed is not None:
+                    print(f'Bodies come from the corpus of [{flow}], sent with the unstrucRemitInfo it was built with [{replayed}]')
+                else:
+                    default_name = f'NFT_{profile.upper() if profile else f"{tps}TPS_{mins}MIN"}_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}'
+                    print(f'What unstrucRemitInfo to use? (Enter for \'{default_name}\')')
+                    name = input()
+                    if name == '':
+                        name = default_name
+                    s.payloads[flow]["additionalRemittanceInfo"] = name
+                s.industry(flow, tps, mins, profile)
+            elif x == 'corpus' or x == 'cb':
+                flow = ''
+                while flow not in s.payloads.keys():
+                    print(f'Which flow would you like to build a corpus for?')
+                    print(f'{s.payloads.keys()}')
+                    flow = input()
+                print(f'How many transactions?')
+                count = int(input())
+
+                # Update unstrucRemitInfo for post analysis
+                default_name = f'NFT_CORPUS_{count}_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}'
+                print(f'What unstrucRemitInfo to use? (Enter for \'{default_name}\')')
+                name = input()
+                if name == '':
+                    name = default_name
+                s.payloads[flow]["additionalRemittanceInfo"] = name
+                s.build_corpus(flow, count)
+            elif x == 'saturate' or x == 'nf':
+                flow = ''
+                while flow not in s.payloads.keys():
+                    print(f'Which flow would you like to find the highest TPS for?')
+                    print(f'{s.payloads.keys()}')
+                    flow = input()
 
                 # Update unstrucRemitInfo for post analysis
-                default_name = f'NFT_{tps}TPS_{mins}MIN_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}'
+                default_name = f'NFT_SATURATION_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}'
                 print(f'What unstrucRemitInfo to use? (Enter for \'{default_name}\')')
                 name = input()
                 if name == '':
                     name = default_name
                 s.payloads[flow]["additionalRemittanceInfo"] = name
-                s.industry(flow, tps, mins)
+                s.saturate(flow)
             elif x == 'extraction' or x == 'ne':
-                print(f'How many transactions per second?')
-                tps = int(input())
-                print(f'For how many minutes?')
-                mins = int(input())
-                s.extraction(tps, mins)
+                print(f'How many transactions per second? (or a load profile: {list((getattr(args, "profiles", None) or {}).keys())})')
+                tps = input()
+                profile = tps if tps in (getattr(args, 'profiles', None) or {}) else None
+                tps = 0 if profile else int(tps)
+                mins = 0
+                if not profile:
+                    print(f'For how many minutes?')
+                    mins = int(input())
+                s.extraction(tps, mins, profile)
+            elif x == 'coordinate' or x == 'nc':
+                kind = ''
+                while kind not in ['industry', 'extraction', 'soak']:
+                    print(f'Which NFT would you like to run across {setting("distributed", "agents", [])}? (industry, extraction, soak)')
+                    kind = input()
+                if kind == 'soak':
+                    flows = set('flows')
+                    while flows.difference(set(s.payloads.keys())):
+                        print(f'Which flows would you like to soak test? Separate flows by space.')
+                        print(f'{s.payloads.keys()}')
+                        flows = set(str(input().replace("'", '')).split(' '))
+                    print(f'How many transactions of each flow per interval in total?')
+                    tpi = int(input())
+                    print(f'How many minutes is each interval?')
+                    interval = int(input())
+                    print(f'For how many minutes?')
+                    mins = int(input())
+                    if s.coordinate({"kind": "soak", "flows": sorted(flows), "tpi": tpi, "mpi": interval, "mins": mins}):
+                        s.save_stats('soak', f'{tpi} TPI every {interval} mins for {mins} mins')
+                else:
+                    flow = 'extraction_bulk'
+                    while kind == 'industry' and flow not in s.payloads.keys():
+                        print(f'Which flow would you like to trigger continuously?')
+                        print(f'{s.payloads.keys()}')
+                        flow = input()
+                    print(f'How many transactions per second in total?')
+                    tps = int(input())
+                    print(f'For how many minutes?')
+                    mins = int(input())
+                    if s.coordinate({"kind": kind, "flow": flow, "tps": tps, "mins": mins}):
+                        s.save_stats(flow, f'{tps} TPS for {mins} mins')
             elif x == 'togglesource' or x == 'ts':
                 s.toggle_source_system()
             elif x == 'soak' or x == 'ns':
-                print(f'How many transactions per interval?')
+                flows = set('flows')
+                while flows.difference(set(s.payloads.keys())):
+                    print(f'Which flows would you like to soak test? Separate flows by space.')
+                    print(f'{s.payloads.keys()}')
+                    flows = set(str(input().replace("'", '')).split(' '))
+                print(f'How many transactions of each flow per interval?')
                 tpi = int(input())
                 print(f'How many minutes is each interval?')
                 interval = int(input())
@@ -886,13 +2741,50 @@ if __name__ == '__main__':
                 name = input()
                 if name == '':
                     name = default_name
-                s.soak(tpi, interval, mins, name)
+                s.soak(sorted(flows), tpi, interval, mins, name)
             elif x == 'save' or x == 'sv':
                 s.save()
             elif x == 'return' or x == 're':
                 s.smokes_return()
-        except:
-            pass
+            elif x == 'returnpipeline' or x == 'rp':
+                s.toggle_pipeline()
+            elif x == 'track' or x == 'tk':
+                if s.tracker.running:
+                    s.tracker.stop()
+                    print('\n'.join(s.tracker.summary()))
+                else:
+                    s.tracker.reset().start()
+            elif x == 'watch' or x == 'w':
+                s.watch()
+            elif (x == 'journal' or x == 'j') and s.journal:
+                run = s.journal_run()
+                if run:
+                    s.journal_report(run)
+            elif x == 'automock' or x == 'am':
+                s.toggle_automock()
+            elif (x == 'journalmock' or x == 'jm') and s.journal:
+                run = s.journal_run()
+                service = 'service'
+                while run and service not in args.payload["mock"].keys():
+                    print(f'Which service would you like to mock?')
+                    print(f'{args.payload["mock"].keys()}')
+                    service = input().replace("'", '')
+                response_value = 'response_value'
+                while run and response_value not in args.payload["mock"][service]["values"]:
+                    print(f'Which response would you like to mock?')
+                    print(f'{args.payload["mock"][service]["values"]}')
+                    response_value = input().replace("'", '')
+                if run:
+                    s.journal_mock(run, service, response_value)
+            elif x == 'e2e':
+                print('\n'.join(s.tracker.summary()))
+            elif (x == 'idcache' or x == 'ic') and s.ids:
+                s.ids.clear()
+                s.logger.info(f'Cleared id cache [{s.ids.path}]')
+        except KeyboardInterrupt:
+            print()
+        except Exception:
+            s.logger.exception(f'Command [{x}] failed')
 
         # Reset additional remittance info
         s.reset_additional_remittance_info()
@@ -906,6 +2798,7 @@ if __name__ == '__main__':
         print(f"  'o' or 'one' \t\t\t smoke test for input transactions")
         print(f"  'u' or 'update' \t\t smoke test for incomplete transactions")
         print(f"  're' or 'return' \t\t smoket test for return/reversal/cancellation transactions")
+        print(f"  'rp' or 'returnpipeline' \t toggle sending each return as soon as its parent is uploaded")
 
         # Result
         print(f"Result")
@@ -914,7 +2807,12 @@ if __name__ == '__main__':
         print(f"  'v' or 'verbose' \t\t print results with all statuses")
         print(f"  'vr' or 'verbosereturn' \t print results with all statuses and returns updated")
         print(f"  'st' or 'status' \t\t print result of one transaction with all statuses")
+        print(f"  'w' or 'watch' \t\t print status changes until all transactions settle")
         print(f"  'sv' or 'save' \t\t save results with all statuses")
+        print(f"  'tk' or 'track' \t\t start/stop tracking end-to-end latency of triggered transactions")
+        print(f"  'e2e' \t\t\t print end-to-end latency of tracked transactions")
+        print(f"  'ic' or 'idcache' \t\t forget firmRootId/p3Id/endToEndId mappings cached from earlier searches")
+        print(f"  'j' or 'journal' \t\t update and report statuses of every transaction of a journalled run")
 
         # Source System
         print(f"Source System")
@@ -935,12 +2833,17 @@ if __name__ == '__main__':
         print(f"  'mp' or 'mockposting' \t mock posting for all transactions")
         print(f"  'mfb' or 'mockfundsbook' \t mock funds 'Credit Req Ack' for all book transactions")
         print(f"  'mpb' or 'mockpostingbook' \t mock posting 'Credit DDA Ack' for all book transactions")
+        print(f"  'jm' or 'journalmock' \t mock response for every unsettled transaction of a journalled run")
+        print(f"  'am' or 'automock' \t\t toggle mocking each mocked transaction as soon as it waits for sanctions/funds/clearing/posting")
 
         # Non Functional Test
         print(f"NFT")
-        print(f"  'nt' or 'tps' \t\t trigger TPS for given a duration")
-        print(f"  'ne' or 'extraction' \t\t trigger extraction bulk TPS for given a duration")
+        print(f"  'nt' or 'tps' \t\t trigger TPS for given a duration, or following a load profile")
+        print(f"  'ne' or 'extraction' \t\t trigger extraction bulk TPS for given a duration, or following a load profile")
         print(f"  'ns' or 'soak' \t\t trigger for soak test")
+        print(f"  'nf' or 'saturate' \t\t find the highest TPS within SLOs by doubling then bisecting")
+        print(f"  'nc' or 'coordinate' \t\t trigger TPS for a given duration across distributed agents")
+        print(f"  'cb' or 'corpus' \t\t build a corpus of unique payloads for 'nt' to replay")
 
         # OTHERS
         print(f"Others")
@@ -950,3 +2853,7 @@ if __name__ == '__main__':
         print(f"  'q' or 'quit' \t\t quit program")
 
         x = input()
+
+    # Cached ids still queued would be lost with the writer thread
+    if s.ids:
+        s.ids.flush()